@@ -0,0 +1 @@
+'''load tests and micro-benchmarks of the blog routes. run "python -m benchmarks --help" from the project root.'''
@@ -0,0 +1,75 @@
+'''command line of the benchmarks
+
+    python -m benchmarks run --users 10000 --posts 100000 --out result.json
+    python -m benchmarks run --reuse-db --baseline result.json
+    python -m benchmarks compare baseline.json result.json
+'''
+import argparse
+import json
+import os
+import sys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='build a synthetic database and measure every route')
+    run_parser.add_argument('--users', type=int, default=1000)
+    run_parser.add_argument('--posts', type=int, default=10000)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--db', default=os.path.join(os.getcwd(), 'bench.db'),
+                            help='path of the benchmark database, it is overwritten')
+    run_parser.add_argument('--reuse-db', action='store_true', help='measure the database built by a previous run')
+    run_parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario')
+    run_parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per scenario')
+    run_parser.add_argument('--transport', action='append', choices=('client', 'http'),
+                            help='flask test client and/or a local http server. default: both')
+    run_parser.add_argument('--concurrency', type=int, default=4, help='client threads for the http transport')
+    run_parser.add_argument('--only', action='append', help='run only this scenario, may be repeated')
+    run_parser.add_argument('--no-cache', dest='cache', action='store_false', help='turn the page cache off')
+    run_parser.add_argument('--profile', default='development', choices=('development', 'production'),
+                            help='config profile of the app, see flaskblog/config.py')
+    run_parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    run_parser.add_argument('--out', help='write the results as JSON to this file. default: stdout')
+    run_parser.add_argument('--baseline', help='compare with this result file, exit 1 on regressions')
+    run_parser.add_argument('--threshold', type=float, default=0.2, help='allowed p95 slowdown, 0.2 is 20%%')
+    run_parser.add_argument('--min-delta-ms', type=float, default=0.5, help='ignore p95 slowdowns below this')
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.2)
+    compare_parser.add_argument('--min-delta-ms', type=float, default=0.5)
+
+    options = parser.parse_args(argv)
+    log = lambda message: print(message, file=sys.stderr)
+
+    if options.command == 'compare':
+        from benchmarks import runner
+        regressions = runner.compare(runner.load(options.baseline), runner.load(options.current),
+                                     options.threshold, options.min_delta_ms, log)
+        return 1 if regressions else 0
+
+    options.transport = options.transport or ['client', 'http']
+    #the app reads its database url and profile when flaskblog is imported
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(options.db)
+    os.environ['FLASKBLOG_CONFIG'] = options.profile
+    from benchmarks import runner
+    results = runner.run(options, log)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.out:
+        with open(options.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if options.baseline:
+        regressions = runner.compare(runner.load(options.baseline), results, options.threshold,
+                                     options.min_delta_ms, log)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
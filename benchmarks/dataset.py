@@ -0,0 +1,73 @@
+'''build synthetic blog databases of a given size'''
+import random
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import text
+
+PASSWORD = 'password'
+WORDS = ('design user experience research interface prototype wireframe layout color type grid motion '
+         'product brand story sketch figma usability test journey persona insight flow pattern system').split()
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def build(db, users, posts, seed=1, batch_size=10000, content_words=120, log=print):
+    ''' this is a function to fill an empty database with synthetic users and posts.
+
+    Args:
+        db: the flaskblog SQLAlchemy object, bound to the benchmark database
+        users: number of users, named user1..userN with email userN@example.com and password 'password'
+        posts: number of posts, spread over the users and over the last years
+        seed: random seed, the same arguments always build the same database
+        batch_size: rows per executemany
+        content_words: average number of words per post
+
+    Return:
+        the number of seconds it took.
+    '''
+    from flaskblog import hashing
+    from flaskblog.models import User, Post
+    from flaskblog.search import rebuild_index
+    from flaskblog.excerpts import make_excerpt
+    from flaskblog.rendering import RENDERER_VERSION, render_html
+    from flaskblog.stats import reconcile_all
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+    #one hash for everybody, hashing a million passwords would take hours
+    pw_hash = hashing.generate_password_hash(PASSWORD)
+    with db.engine.begin() as conn:
+        for first in range(1, users + 1, batch_size):
+            conn.execute(User.__table__.insert(), [
+                {'id': i, 'username': 'user%d' % i, 'email': 'user%d@example.com' % i,
+                 'image_file': 'default.jpg', 'password': pw_hash}
+                for i in range(first, min(first + batch_size, users + 1))])
+    log('built %d users' % users)
+    #posts are indexed once at the end, which is much faster than row by row
+    with db.engine.begin() as conn:
+        for trigger in ('post_fts_insert', 'post_fts_update', 'post_fts_delete'):
+            conn.execute(text('DROP TRIGGER IF EXISTS %s' % trigger))
+    newest = datetime(2024, 1, 1)
+    step = timedelta(minutes=7)
+    for first in range(1, posts + 1, batch_size):
+        with db.engine.begin() as conn:
+            rows = [{'id': i, 'title': _text(rng, rng.randint(3, 9)).capitalize(),
+                     'content': _text(rng, rng.randint(content_words // 2, content_words * 3 // 2)),
+                     'date_posted': newest - step * (posts - i), 'user_id': rng.randint(1, users)}
+                    for i in range(first, min(first + batch_size, posts + 1))]
+            for row in rows:
+                row['updated_at'] = row['date_posted']
+                row['content_html'] = render_html(row['content'])
+                row['excerpt'] = make_excerpt(row['content_html'])
+                row['renderer_version'] = RENDERER_VERSION
+            conn.execute(Post.__table__.insert(), rows)
+        log('built %d posts' % min(first + batch_size - 1, posts))
+    for _ in rebuild_index():
+        pass
+    #the posts were inserted without the orm, count them per author once
+    for _ in reconcile_all():
+        pass
+    return time.perf_counter() - start
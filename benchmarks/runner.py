@@ -0,0 +1,403 @@
+'''drive the routes through the flask test client or a local http server and measure them'''
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from http.cookiejar import CookieJar
+from PIL import Image
+from sqlalchemy import event, func
+from werkzeug.serving import WSGIRequestHandler, make_server
+from benchmarks import dataset
+
+
+#one place to count the SQL statements of every request, whatever thread runs it
+class StatementCounter(object):
+
+    def __init__(self, *engines):
+        self.count = 0
+        self._lock = threading.Lock()
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._record)
+
+    def _record(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def percentile(values, pct):
+    ''' this is a function to get the nearest-rank percentile of a sorted list.'''
+    if not values:
+        return None
+    index = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def upload_image(seed):
+    ''' this is a function to make the jpeg used by the account upload scenario. the same seed gives the same bytes.'''
+    rng = random.Random(seed)
+    size = 1600 * 1200 * 3
+    image = Image.frombytes('RGB', (1600, 1200), rng.getrandbits(8 * size).to_bytes(size, 'little'))
+    buf = io.BytesIO()
+    image.save(buf, 'JPEG', quality=90)
+    return buf.getvalue()
+
+
+class ClientTransport(object):
+    '''this is a transport through app.test_client(), no network and no server in between.'''
+    name = 'client'
+
+    def __init__(self, app):
+        self.app = app
+
+    def session(self):
+        return self.app.test_client()
+
+    def request(self, session, method, path, data=None, files=None):
+        if files:
+            data = dict(data or {})
+            for field, (filename, content) in files.items():
+                data[field] = (io.BytesIO(content), filename)
+            return session.open(path, method=method, data=data, content_type='multipart/form-data').status_code
+        return session.open(path, method=method, data=data).status_code
+
+
+class HttpTransport(object):
+    '''this is a transport through a real threaded werkzeug server on a local port.'''
+    name = 'http'
+
+    def __init__(self, app):
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        self.base = 'http://127.0.0.1:%d' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+
+    def session(self):
+        #redirects are not followed, the benchmark measures one round trip per request
+        class NoRedirect(urllib.request.HTTPRedirectHandler):
+            def redirect_request(self, *args, **kwargs):
+                return None
+        return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect)
+
+    def request(self, session, method, path, data=None, files=None):
+        headers = {}
+        body = None
+        if files:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for field, value in (data or {}).items():
+                parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                              % (boundary, field, value)).encode('utf-8'))
+            for field, (filename, content) in files.items():
+                parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                              'Content-Type: application/octet-stream\r\n\r\n' % (boundary, field, filename)).encode('utf-8'))
+                parts.append(content + b'\r\n')
+            parts.append(('--%s--\r\n' % boundary).encode('utf-8'))
+            body = b''.join(parts)
+            headers['Content-Type'] = 'multipart/form-data; boundary=' + boundary
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base + path, data=body, headers=headers, method=method)
+        try:
+            with session.open(req) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+class Scenarios(object):
+    '''this is the list of requests the benchmark sends. every route of flaskblog/routes.py and
+    flaskblog/api.py is covered, the forms by their POST. /metrics is not.
+
+    Each scenario is (name, session, function(i) -> (method, path, data, files)). session is
+    'anon' for a logged out client, 'user' for a client logged in as user1, 'fresh' for a new
+    logged out client on every request, so that /login really checks the password each time, and
+    'fresh_user' for a new client logged in as user1 on every request, for /logout. i starts at 0
+    again in every run of a scenario, e.g. the warm up and the measured run.
+    '''
+
+    #the scenarios measured with the page cache off, they compare the queries behind a page
+    UNCACHED = frozenset(['home_deep_offset', 'home_deep_cursor'])
+
+    def __init__(self, app, db, users, posts, seed):
+        from flaskblog.models import Post
+        from flaskblog.pagination import encode_cursor
+        self.app = app
+        self.db = db
+        self.rng = random.Random(seed)
+        self.users = users
+        self.posts = posts
+        self.image = upload_image(seed)
+        self.nonce = uuid.uuid4().hex[:8]
+        #new usernames over every run of register, i repeats
+        self.serial = itertools.count()
+        #posts of new_post, deleted by delete_post. loaded from the database whenever it runs out
+        self.new_posts = []
+        self.new_posts_lock = threading.Lock()
+        #cursors of pages deep in the feed, the ones that used to cost an OFFSET scan
+        depth = max(posts * 9 // 10, 1)
+        with app.app_context():
+            deep = Post.query.order_by(Post.date_posted.desc(), Post.id.desc()).offset(depth - 1).first()
+            self.deep_cursor = encode_cursor(deep, depth // 5 + 1, 'next') if deep else None
+            own = db.session.query(Post.id).filter(Post.user_id == 1).order_by(Post.id).first()
+            self.own_post = own.id if own else None
+        self.deep_page = max(depth // 5, 1)
+
+    def _register(self, i):
+        number = next(self.serial)
+        return ('POST', '/register', {
+            'username': 'b%s%d' % (self.nonce, number), 'email': 'b%s%d@example.com' % (self.nonce, number),
+            'password': 'pw', 'confirm_password': 'pw'}, None)
+
+    def _delete_post(self, i):
+        from flaskblog.models import Post
+        with self.new_posts_lock:
+            if not self.new_posts:
+                with self.app.app_context():
+                    self.new_posts = [row.id for row in self.db.session.query(Post.id).filter(
+                        Post.user_id == 1, Post.title.like('Benchmark new %')).order_by(Post.id.desc())]
+            #0 is a 404 and counts as an error: delete_post deletes what new_post wrote, run both
+            post_id = self.new_posts.pop() if self.new_posts else 0
+        return ('POST', '/post/%d/delete' % post_id, None, None)
+
+    def all(self):
+        rng = self.rng
+        scenarios = [
+            ('home', 'anon', lambda i: ('GET', '/', None, None)),
+            ('home_deep_offset', 'anon', lambda i: ('GET', '/home?page=%d' % self.deep_page, None, None)),
+            ('post', 'anon', lambda i: ('GET', '/post/%d' % rng.randint(1, self.posts), None, None)),
+            ('user_posts', 'anon', lambda i: ('GET', '/user/user%d' % rng.randint(1, self.users), None, None)),
+            ('about', 'anon', lambda i: ('GET', '/about', None, None)),
+            ('api_posts', 'anon', lambda i: ('GET', '/api/posts', None, None)),
+            #one call for the posts of a whole screen, instead of one /post page each
+            ('api_posts_ids', 'anon', lambda i: ('GET', '/api/posts?ids=%s&fields=id,title,content_html,author' % ','.join(
+                str(rng.randint(1, self.posts)) for _ in range(20)), None, None)),
+            ('api_user_posts', 'anon', lambda i: ('GET', '/api/users/user%d/posts' % rng.randint(1, self.users), None, None)),
+            ('search', 'anon', lambda i: ('GET', '/search?q=%s' % rng.choice(dataset.WORDS), None, None)),
+            ('login', 'fresh', lambda i: ('POST', '/login', {
+                'email': 'user%d@example.com' % rng.randint(1, self.users), 'password': dataset.PASSWORD}, None)),
+            ('register', 'anon', self._register),
+            ('availability', 'anon', lambda i: ('GET', '/api/availability?username=user%d&email=user%d@example.com' % (
+                rng.randint(1, self.users), rng.randint(1, self.users)), None, None)),
+            ('feed_atom', 'anon', lambda i: ('GET', '/feed.atom', None, None)),
+            ('feed_json', 'anon', lambda i: ('GET', '/feed.json', None, None)),
+            ('user_feed_atom', 'anon', lambda i: ('GET', '/user/user%d/feed.atom' % rng.randint(1, self.users), None, None)),
+            ('home_logged_in', 'user', lambda i: ('GET', '/', None, None)),
+            ('account', 'user', lambda i: ('GET', '/account', None, None)),
+            ('new_post', 'user', lambda i: ('POST', '/post/new', {
+                'title': 'Benchmark new %d' % i, 'content': ' '.join(dataset.WORDS)}, None)),
+            ('update_post', 'user', lambda i: ('POST', '/post/%d/update' % self.own_post, {
+                'title': 'Benchmark update %d' % i, 'content': ' '.join(dataset.WORDS)}, None)),
+            ('delete_post', 'user', self._delete_post),
+            ('account_upload', 'user', lambda i: ('POST', '/account', {
+                'username': 'user1', 'email': 'user1@example.com'}, {'picture': ('bench.jpg', self.image)})),
+            ('logout', 'fresh_user', lambda i: ('GET', '/logout', None, None)),
+        ]
+        if not self.own_post:
+            #user1 has no post to update
+            scenarios = [scenario for scenario in scenarios if scenario[0] != 'update_post']
+        if self.deep_cursor:
+            scenarios.insert(1, ('home_deep_cursor', 'anon',
+                                 lambda i: ('GET', '/home?cursor=' + self.deep_cursor, None, None)))
+        return scenarios
+
+
+def run_scenario(transport, make_request, session_mode, requests, concurrency, counter):
+    ''' this is a function to send requests of one scenario and collect the numbers.
+
+    Return:
+        dict with n, errors, p50/p95/p99/mean latency in ms, requests per second and SQL statements per request.
+    '''
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    jobs = iter(range(requests))
+
+    def login(session):
+        transport.request(session, 'POST', '/login', {'email': 'user1@example.com', 'password': dataset.PASSWORD})
+
+    def worker():
+        session = transport.session()
+        if session_mode == 'user':
+            login(session)
+        while True:
+            with lock:
+                i = next(jobs, None)
+            if i is None:
+                return
+            if session_mode in ('fresh', 'fresh_user'):
+                session = transport.session()
+            if session_mode == 'fresh_user':
+                #not timed, but its statements are counted
+                login(session)
+            method, path, data, files = make_request(i)
+            start = time.perf_counter()
+            status = transport.request(session, method, path, data, files)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors[0] += 1
+
+    statements = counter.count
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'n': len(latencies),
+        'errors': errors[0],
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'rps': round(len(latencies) / wall, 1) if wall else None,
+        #login requests of the workers are counted too, that is a handful per scenario, one per request for fresh_user
+        'sql_per_request': round((counter.count - statements) / float(max(len(latencies), 1)), 2),
+    }
+
+
+def run(options, log=print):
+    ''' this is a function to build or reuse the benchmark database and run every scenario.
+
+    Args:
+        options: the parsed command line, see benchmarks/__main__.py
+
+    Return:
+        the results as a JSON serialisable dict.
+    '''
+    from flaskblog import app, db, cache, jobs, storage
+    from flaskblog.cache import NullBackend
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['BCRYPT_LOG_ROUNDS'] = options.bcrypt_rounds
+    app.config['CACHE_TYPE'] = 'lru' if options.cache else 'null'
+    cache.init_app(app)
+    build_seconds = None
+    with app.app_context():
+        counter = StatementCounter(*db.engines.values())
+        if not options.reuse_db:
+            build_seconds = dataset.build(db, options.users, options.posts, options.seed, log=log)
+            log('database built in %.1fs' % build_seconds)
+        else:
+            #take the size of the database from the last run, not from the command line
+            from flaskblog.models import User, Post
+            options.users = db.session.query(func.max(User.id)).scalar() or 0
+            options.posts = db.session.query(func.max(Post.id)).scalar() or 0
+    scenarios = Scenarios(app, db, options.users, options.posts, options.seed)
+    picture = storage.content_name(scenarios.image)
+    had_picture = storage.exists(picture + '.jpg')
+    results = {}
+    for transport_name in options.transport:
+        transport = ClientTransport(app) if transport_name == 'client' else HttpTransport(app)
+        results[transport_name] = {}
+        try:
+            for name, session_mode, make_request in scenarios.all():
+                if options.only and name not in options.only:
+                    continue
+                concurrency = options.concurrency if transport_name == 'http' else 1
+                backend = cache.backend
+                if name in scenarios.UNCACHED:
+                    cache.backend = NullBackend()
+                try:
+                    #warm up caches and connections, these requests are not measured
+                    run_scenario(transport, make_request, session_mode, min(options.warmup, options.requests), 1, counter)
+                    results[transport_name][name] = stats = run_scenario(
+                        transport, make_request, session_mode, options.requests, concurrency, counter)
+                finally:
+                    cache.backend = backend
+                log('%-6s %-18s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %8.1f req/s  %5.1f sql/req  %d errors' % (
+                    transport_name, name, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+                    stats['rps'], stats['sql_per_request'], stats['errors']))
+        finally:
+            if transport_name == 'http':
+                transport.close()
+    #the avatar jobs of the upload scenario write into static/profile_pics, clean up after them
+    with app.app_context():
+        jobs.wait_idle()
+    if not had_picture:
+        folder = os.path.dirname(storage.path_of(picture))
+        prefix = os.path.basename(picture)
+        for filename in os.listdir(folder) if os.path.isdir(folder) else ():
+            if filename.startswith(prefix):
+                os.remove(os.path.join(folder, filename))
+        try:
+            #drop the shard folders again if they are empty
+            os.removedirs(folder)
+        except OSError:
+            pass
+    return {
+        'meta': {
+            'users': options.users, 'posts': options.posts, 'seed': options.seed,
+            'requests': options.requests, 'concurrency': options.concurrency, 'cache': options.cache,
+            'profile': options.profile, 'bcrypt_rounds': options.bcrypt_rounds, 'build_seconds': build_seconds,
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'scenarios': results,
+        #ru_maxrss is in kilobytes on linux and in bytes on macos
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if platform.system() == 'Darwin' else 1),
+    }
+
+
+def compare(baseline, current, threshold, min_delta_ms=0.5, log=print):
+    ''' this is a function to compare two result files.
+
+    Args:
+        baseline, current: dicts returned by run
+        threshold: allowed relative slowdown of p95, e.g. 0.2 for 20%
+        min_delta_ms: slowdowns smaller than this are noise, whatever their percentage
+
+    Return:
+        the list of regressions. a scenario regresses if its p95 grows by more than threshold and min_delta_ms,
+        or if it runs more SQL statements per request than the baseline.
+    '''
+    for key in ('users', 'posts', 'cache', 'profile', 'bcrypt_rounds', 'concurrency'):
+        if baseline.get('meta', {}).get(key) != current['meta'].get(key):
+            log('warning: %s differs, %r in the baseline and %r now' % (
+                key, baseline.get('meta', {}).get(key), current['meta'].get(key)))
+    regressions = []
+    for transport, scenarios in sorted(current['scenarios'].items()):
+        for name, now in sorted(scenarios.items()):
+            before = baseline.get('scenarios', {}).get(transport, {}).get(name)
+            if not before or not before['p95_ms']:
+                log('%-6s %-18s new scenario' % (transport, name))
+                continue
+            change = now['p95_ms'] / before['p95_ms'] - 1
+            slower = change > threshold and now['p95_ms'] - before['p95_ms'] > min_delta_ms
+            sql_change = now['sql_per_request'] - before['sql_per_request']
+            flag = ''
+            if slower or sql_change > 0.5:
+                flag = 'REGRESSION'
+                regressions.append({'transport': transport, 'scenario': name, 'p95_change': round(change, 3),
+                                    'sql_change': round(sql_change, 2)})
+            log('%-6s %-18s p95 %8.2fms -> %8.2fms (%+6.1f%%)  sql %5.1f -> %5.1f  %s' % (
+                transport, name, before['p95_ms'], now['p95_ms'], change * 100,
+                before['sql_per_request'], now['sql_per_request'], flag))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
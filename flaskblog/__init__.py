@@ -1,16 +1,50 @@
+import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 from flask_login import LoginManager
+from flaskblog.cache import Cache
+from flaskblog import config
+from flaskblog.database import RoutingSession, READ_BIND, configure_engines, read_engine_bind
+
+
+#not an application factory: the extensions and routes below are bound to the one module level app
+def configure_app(profile=None):
+    ''' this is a function to make the flask app and load a config profile into it.
+
+    Args:
+        profile: a name in flaskblog.config.profiles. default: the FLASKBLOG_CONFIG environment variable,
+            or 'development'
+
+    Return:
+        the configured app, without routes and extensions. only the app made at import has them, so
+        pick the profile with FLASKBLOG_CONFIG before flaskblog is imported.
+    '''
+    app = Flask(__name__)
+    app.config.from_object(config.profiles[profile or os.environ.get('FLASKBLOG_CONFIG', 'development')])
+    if app.config['SQLALCHEMY_READ_ENGINE']:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds.setdefault(READ_BIND, read_engine_bind(app.config))
+        app.config['SQLALCHEMY_BINDS'] = binds
+    return app
+
 
 '''create the flask app. preload packages.'''
-app = Flask(__name__)
-app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
-db = SQLAlchemy(app)
+app = configure_app()
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+configure_engines(app, db)
 bcrypt = Bcrypt(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
+cache = Cache(app)
+#logged in users are loaded from here instead of the user table, see load_user in models.py
+app.config.setdefault('IDENTITY_CACHE_MAX_ENTRIES', 10000)
+app.config.setdefault('IDENTITY_CACHE_MAX_BYTES', 4 * 1024 * 1024)
+identity_cache = Cache(app, 'IDENTITY_CACHE')
 
-from flaskblog import routes
\ No newline at end of file
+#request, SQL, template, image and bcrypt timings, served on /metrics
+from flaskblog import metrics
+from flaskblog import assets, routes, api, commands
+#the listeners that keep the author statistics of flaskblog/stats.py with the posts
+from flaskblog import stats
@@ -0,0 +1,245 @@
+'''read only JSON API of the posts, for the clients that would otherwise scrape the pages'''
+import json
+from flask import Response, abort, request, url_for
+from sqlalchemy import func, select, tuple_
+from flaskblog import app, db, cache
+from flaskblog.conditional import conditional_page, last_change, make_etag
+from flaskblog.database import read_only
+from flaskblog.models import User, Post
+from flaskblog.pagination import decode_cursor, encode_cursor
+from flaskblog.rendering import render_html
+
+#orjson is optional, it writes the answers several times faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+app.config.setdefault('API_PAGE_SIZE', 20)
+app.config.setdefault('API_MAX_PAGE_SIZE', 100)
+#posts of one ?ids= request, at most
+app.config.setdefault('API_MAX_IDS', 100)
+
+#field -> column it is read from. only the columns of the asked fields are selected, so
+#content and content_html stay in the database unless they are asked for
+COLUMNS = {
+    'id': Post.id,
+    'title': Post.title,
+    'date_posted': Post.date_posted,
+    'updated_at': Post.updated_at,
+    'excerpt': Post.excerpt,
+    'content': Post.content,
+    'content_html': Post.content_html,
+    'author_id': Post.user_id,
+    'author': User.username,
+}
+#url is built from the id
+FIELDS = tuple(COLUMNS) + ('url',)
+DEFAULT_FIELDS = ('id', 'title', 'date_posted', 'updated_at', 'excerpt', 'author', 'url')
+
+
+def _error(status, message):
+    abort(Response(json.dumps({'error': message}), status, mimetype='application/json'))
+
+
+def _dump(value):
+    #compact, and the text is not escaped to \u sequences. both write the same json
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def requested_fields():
+    ''' this is a function to read ?fields=id,title,... answer 400 for an unknown field.
+
+    Return:
+        the field names in the asked order, DEFAULT_FIELDS if there is no fields argument.
+    '''
+    value = request.args.get('fields')
+    if not value:
+        return DEFAULT_FIELDS
+    fields = []
+    for field in value.split(','):
+        field = field.strip()
+        if field not in FIELDS:
+            _error(400, 'unknown field %r, the fields are %s' % (field, ', '.join(FIELDS)))
+        if field not in fields:
+            fields.append(field)
+    return tuple(fields)
+
+
+#the select of the asked fields. id, date_posted and user_id are always read, for the cursor and the cache tags
+def select_fields(fields):
+    ''' this is a function to build the SELECT of the columns behind fields. the author is joined if it is asked for.'''
+    columns = dict((name, COLUMNS[name]) for name in ('id', 'date_posted', 'author_id'))
+    columns.update((name, COLUMNS[name]) for name in fields if name in COLUMNS)
+    query = select(*[column.label(name) for name, column in columns.items()])
+    if 'author' in fields:
+        query = query.join(User, User.id == Post.user_id)
+    return query.select_from(Post)
+
+
+def _convert(field):
+    if field == 'url':
+        return lambda row: url_for('post', post_id=row.id, _external=True)
+    if field in ('date_posted', 'updated_at'):
+        return lambda row: getattr(row, field).isoformat() + 'Z' if getattr(row, field) is not None else None
+    return lambda row: getattr(row, field)
+
+
+#rows to dicts without orm objects. the converters are picked once per request, not once per value
+def serialize(rows, fields, tags):
+    ''' this is a function to turn the selected rows into the posts of the answer.
+
+    Args:
+        rows: rows of select_fields
+        fields: the asked fields
+        tags: list the cache tags of every post are appended to
+
+    Return:
+        a list of dicts with the fields in the asked order.
+    '''
+    converters = [(field, _convert(field)) for field in fields]
+    posts = [dict((field, convert(row)) for field, convert in converters) for row in rows]
+    for row in rows:
+        tags.append('post:%d' % row.id)
+        tags.append('user:%d' % row.author_id)
+    if 'content_html' in fields:
+        #posts stored before render-on-write have no html yet, render them from their content
+        #row.id, the id is selected even when it is not one of the asked fields
+        missing = dict((row.id, post) for post, row in zip(posts, rows) if row.content_html is None)
+        if missing:
+            for post_id, content in db.session.execute(
+                    select(Post.id, Post.content).where(Post.id.in_(list(missing)))):
+                missing[post_id]['content_html'] = render_html(content)
+    return posts
+
+
+def _limit():
+    limit = request.args.get('limit', app.config['API_PAGE_SIZE'], type=int)
+    return min(max(limit, 1), app.config['API_MAX_PAGE_SIZE'])
+
+
+#one page newest first, by keyset on (date_posted, id) like the html pages
+def post_page(fields, cursor, limit, user_id=None):
+    ''' this is a function to load one page of posts.
+
+    Args:
+        fields: the asked fields
+        cursor: next_cursor of the page before, or None for the newest posts
+        limit: posts per page
+        user_id: only the posts of this author
+
+    Return:
+        (the answer as a dict, cache tags)
+    '''
+    query = select_fields(fields)
+    page = 1
+    if cursor:
+        date_posted, post_id, page, direction = decode_cursor(cursor)
+        if direction != 'next':
+            _error(400, 'the api only pages towards older posts')
+        query = query.where(tuple_(Post.date_posted, Post.id) < (date_posted, post_id))
+    if user_id is not None:
+        query = query.where(Post.user_id == user_id)
+    rows = db.session.execute(
+        query.order_by(Post.date_posted.desc(), Post.id.desc()).limit(limit + 1)).all()
+    tags = []
+    result = {'posts': serialize(rows[:limit], fields, tags), 'next_cursor': None, 'next': None}
+    if len(rows) > limit:
+        result['next_cursor'] = encode_cursor(rows[limit - 1], page + 1, 'next')
+        args = dict(request.view_args, cursor=result['next_cursor'], limit=limit)
+        if 'fields' in request.args:
+            args['fields'] = ','.join(fields)
+        result['next'] = url_for(request.endpoint, _external=True, **args)
+    return result, tags
+
+
+def _ids():
+    try:
+        ids = [int(value) for value in request.args['ids'].split(',') if value.strip()]
+    except ValueError:
+        _error(400, 'ids must be a comma separated list of post ids')
+    if len(ids) > app.config['API_MAX_IDS']:
+        _error(400, 'at most %d ids per request' % app.config['API_MAX_IDS'])
+    #duplicates are answered once, in the order they were first asked
+    return list(dict.fromkeys(ids))
+
+
+def _json(render):
+    return lambda: Response(render(), mimetype='application/json')
+
+
+#the answers are the same for everybody, so they are cached once and proxies may keep them
+@app.route("/api/posts")
+@read_only
+def api_posts():
+    ''' this is a function to list the posts as json.
+
+    Args:
+        ids: comma separated post ids. they are loaded with one query and answered in the asked order
+        cursor: next_cursor of the page before, without ids
+        limit: posts per page, API_PAGE_SIZE by default, at most API_MAX_PAGE_SIZE
+        fields: comma separated fields of the posts, see FIELDS. content is only read if it is asked for
+
+    Return:
+        {'posts': [...], 'missing': [ids that do not exist]} for ids,
+        else {'posts': [...], 'next_cursor': ..., 'next': url of the next page}.
+        304 if the client has the current answer.
+    '''
+    fields = requested_fields()
+    if 'ids' in request.args:
+        ids = _ids()
+        #deleted posts change the count, renamed authors the 'authors' version
+        last_modified, found = db.session.query(func.max(Post.updated_at), func.count(Post.id)).filter(
+            Post.id.in_(ids)).one()
+        last_modified = last_change(last_modified, 'authors')
+        etag = make_etag('api_posts', ids, fields, last_modified, found, cache.tag_version('authors'))
+
+        def render():
+            rows = db.session.execute(select_fields(fields).where(Post.id.in_(ids))).all()
+            tags = []
+            posts = dict((row.id, post) for row, post in zip(rows, serialize(rows, fields, tags)))
+            missing = [post_id for post_id in ids if post_id not in posts]
+            if missing:
+                #a missing id may be the next new post
+                tags.append('feed')
+            return _dump({'posts': [posts[post_id] for post_id in ids if post_id in posts],
+                          'missing': missing}), tags
+        key = 'api_posts:ids:%s:%s:%s' % (','.join(map(str, ids)), ','.join(fields), request.host_url)
+    else:
+        cursor, limit = request.args.get('cursor'), _limit()
+        last_modified = last_change(db.session.query(func.max(Post.updated_at)).scalar(), 'feed', 'authors')
+        etag = make_etag('api_posts', cursor, limit, fields, last_modified,
+                         cache.tag_version('feed'), cache.tag_version('authors'))
+
+        def render():
+            result, tags = post_page(fields, cursor, limit)
+            return _dump(result), tags + ['feed']
+        key = 'api_posts:%s:%d:%s:%s' % (cursor, limit, ','.join(fields), request.host_url)
+    return conditional_page(etag, last_modified, _json(lambda: cache.page(key, render)), public=True)
+
+
+@app.route("/api/users/<string:username>/posts")
+@read_only
+def api_user_posts(username):
+    ''' this is a function to list the posts of one author as json. the arguments are the ones of api_posts, without ids.
+
+    Return:
+        {'posts': [...], 'next_cursor': ..., 'next': url of the next page}. 404 for an unknown user.
+    '''
+    fields = requested_fields()
+    cursor, limit = request.args.get('cursor'), _limit()
+    author = db.session.query(User.id).filter_by(username=username).first()
+    if author is None:
+        _error(404, 'no user %r' % username)
+    last_modified = last_change(db.session.query(func.max(Post.updated_at)).filter(Post.user_id == author.id).scalar(),
+                                'user:%d' % author.id, 'feed:user:%d' % author.id)
+    etag = make_etag('api_user_posts', username, cursor, limit, fields, last_modified,
+                     cache.tag_version('user:%d' % author.id), cache.tag_version('feed:user:%d' % author.id))
+
+    def render():
+        result, tags = post_page(fields, cursor, limit, author.id)
+        return _dump(result), tags + ['user:%d' % author.id, 'feed:user:%d' % author.id]
+    key = 'api_user_posts:%s:%s:%d:%s:%s' % (username, cursor, limit, ','.join(fields), request.host_url)
+    return conditional_page(etag, last_modified, _json(lambda: cache.page(key, render)), public=True)
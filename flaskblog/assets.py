@@ -0,0 +1,184 @@
+'''fingerprinted, precompressed static files: the build step, the url_for rewrite and the static view'''
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+from flask import request, send_from_directory
+from flaskblog import app, storage
+
+#brotli is optional, without it only gzip variants are built
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#the built files go to static/<ASSETS_DIR>, next to a manifest.json
+app.config.setdefault('ASSETS_DIR', 'dist')
+app.config.setdefault('ASSETS_MAX_AGE', 365 * 24 * 3600)
+#the production profile turns it on. in development main.css is served as it is edited
+app.config.setdefault('ASSETS_FINGERPRINT', False)
+
+COMPRESSIBLE = frozenset(['.css', '.js', '.json', '.map', '.svg', '.txt', '.xml', '.html', '.ico'])
+#preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+#static filename -> {'path': built filename, 'encodings': [...]}, see load_manifest
+manifest = {}
+#built filename -> encodings on disk
+_built = {}
+
+
+def _manifest_path():
+    return os.path.join(app.static_folder, app.config['ASSETS_DIR'], 'manifest.json')
+
+
+def _compress(encoding, data):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11) if brotli is not None else None
+    return gzip.compress(data, 9, mtime=0)
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+#every file under static except the build output, dot files and the stored pictures, which are named by content already
+def iter_sources():
+    ''' this is a function to list the static files to fingerprint, relative to the static folder with '/' separators.'''
+    static = app.static_folder
+    for folder, dirs, files in os.walk(static):
+        rel_folder = os.path.relpath(folder, static).replace(os.sep, '/')
+        if rel_folder == '.':
+            dirs[:] = [d for d in dirs if d != app.config['ASSETS_DIR']]
+        elif rel_folder == 'profile_pics':
+            dirs[:] = []
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for filename in sorted(files):
+            if not filename.startswith('.'):
+                yield filename if rel_folder == '.' else rel_folder + '/' + filename
+
+
+def build(clean=False):
+    ''' this is a function to build the fingerprinted static files and their manifest.
+
+    Args:
+        clean: delete the built files the new manifest does not list any more
+
+    Return:
+        the new manifest. every file is copied to <ASSETS_DIR>/<name>.<hash><ext>, with .gz (and .br
+        if brotli is installed) next to it when the type compresses and the compressed file is smaller.
+    '''
+    static = app.static_folder
+    files = {}
+    for name in iter_sources():
+        with open(os.path.join(static, *name.split('/')), 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        built = '%s/%s.%s%s' % (app.config['ASSETS_DIR'], stem, hashlib.sha256(data).hexdigest()[:12], ext)
+        path = os.path.join(static, *built.split('/'))
+        _write(path, data)
+        encodings = []
+        if ext.lower() in COMPRESSIBLE:
+            for encoding, suffix in ENCODINGS:
+                packed = _compress(encoding, data)
+                if packed is not None and len(packed) < len(data):
+                    _write(path + suffix, packed)
+                    encodings.append(encoding)
+        files[name] = {'path': built, 'encodings': encodings}
+    _write(_manifest_path(), json.dumps(files, indent=2, sort_keys=True).encode('utf-8'))
+    if clean:
+        keep = set()
+        for entry in files.values():
+            keep.add(entry['path'])
+            keep.update(entry['path'] + suffix for encoding, suffix in ENCODINGS if encoding in entry['encodings'])
+        out = os.path.join(static, app.config['ASSETS_DIR'])
+        for folder, dirs, filenames in os.walk(out):
+            for filename in filenames:
+                path = os.path.join(folder, filename)
+                rel_path = os.path.relpath(path, static).replace(os.sep, '/')
+                if rel_path not in keep and path != _manifest_path():
+                    os.remove(path)
+    load_manifest()
+    return files
+
+
+def load_manifest():
+    ''' this is a function to read the manifest written by build. return the number of files it lists.'''
+    manifest.clear()
+    _built.clear()
+    if not app.config['ASSETS_FINGERPRINT']:
+        return 0
+    try:
+        with open(_manifest_path(), encoding='utf-8') as f:
+            manifest.update(json.load(f))
+    except (OSError, ValueError):
+        app.logger.warning('no static manifest at %s, run flask blog build-assets', _manifest_path())
+        return 0
+    for entry in manifest.values():
+        _built[entry['path']] = entry['encodings']
+    return len(manifest)
+
+
+#url_for('static', filename='main.css') gives /static/dist/main.<hash>.css once the manifest is loaded
+@app.url_defaults
+def _fingerprint(endpoint, values):
+    if endpoint == 'static' and manifest:
+        entry = manifest.get(values.get('filename'))
+        if entry is not None:
+            values['filename'] = entry['path']
+
+
+def _immutable(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['ASSETS_MAX_AGE']
+    response.cache_control.immutable = True
+    response.cache_control.no_cache = None
+    return response
+
+
+def serve_static(filename):
+    ''' this is a function to serve a static file. it replaces the view of the 'static' endpoint.
+
+    Args:
+        filename: path under the static folder
+
+    Return:
+        built files and stored pictures with a year long, immutable Cache-Control. built files
+        in the best precompressed variant the Accept-Encoding allows. anything else as flask serves it.
+    '''
+    if filename in _built:
+        for encoding, suffix in ENCODINGS:
+            if encoding in _built[filename] and request.accept_encodings.quality(encoding) > 0:
+                response = send_from_directory(app.static_folder, filename + suffix,
+                                               mimetype=mimetypes.guess_type(filename)[0],
+                                               max_age=app.config['ASSETS_MAX_AGE'])
+                response.content_encoding = encoding
+                break
+        else:
+            response = app.send_static_file(filename)
+        response.vary.add('Accept-Encoding')
+        return _immutable(response)
+    if filename.startswith('profile_pics/') and storage.is_content_name(filename[len('profile_pics/'):]):
+        return _immutable(app.send_static_file(filename))
+    return app.send_static_file(filename)
+
+
+#flask-login reads the session on every request, which makes flask add Vary: Cookie when it saves it.
+#an immutable file is the same for every cookie, and with that Vary a proxy would keep one copy per user.
+class _SessionInterface(app.session_interface.__class__):
+
+    def save_session(self, app, session, response):
+        super(_SessionInterface, self).save_session(app, session, response)
+        if request.endpoint == 'static' and response.cache_control.immutable:
+            #lower case: HeaderSet.discard only drops the header when given its lowered name
+            response.vary.discard('cookie')
+
+
+app.session_interface = _SessionInterface()
+app.view_functions['static'] = serve_static
+load_manifest()
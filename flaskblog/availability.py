@@ -0,0 +1,149 @@
+'''in-memory index of the taken usernames and emails, for live form checks without a query per keystroke'''
+import logging
+import threading
+import time
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+from flaskblog import app, db
+from flaskblog.models import User
+
+logger = logging.getLogger(__name__)
+
+#seconds between rebuilds from the user table. other worker processes register users this index does not see
+app.config.setdefault('AVAILABILITY_REFRESH', 300)
+#seconds a lookup waits for the first build before it asks the user table itself
+app.config.setdefault('AVAILABILITY_WAIT', 5)
+FIELDS = ('username', 'email')
+
+
+def normalize(value):
+    ''' this is a function to get the form of a username or email the index compares. 'Bob ' and 'bob' are the same.'''
+    return (value or '').strip().casefold()
+
+
+class AvailabilityIndex(object):
+    '''this is a set of the normalized usernames and emails of every user.
+
+    It is built from the user table in a background thread on the first request, and again every
+    AVAILABILITY_REFRESH seconds. register and account tell it about their changes right away.
+    Lookups made before the first build wait for it, at most AVAILABILITY_WAIT seconds, and query
+    the user table while there is no index. The unique constraints of the user table stay the
+    final word: the index can only make a duplicate fail earlier, with a nicer message.
+
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._taken = dict((field, set()) for field in FIELDS)
+        #changes made while a rebuild reads the table, replayed on the new sets
+        self._changes = None
+        self._built_at = 0.0
+        self._building = False
+        #False until a build read the table
+        self._loaded = False
+
+    def _load(self):
+        taken = dict((field, set()) for field in FIELDS)
+        with app.app_context():
+            result = db.session.execute(db.select(User.username, User.email).execution_options(yield_per=5000))
+            for username, email in result:
+                taken['username'].add(normalize(username))
+                taken['email'].add(normalize(email))
+            db.session.remove()
+        return taken
+
+    def build(self):
+        ''' this is a function to (re)build the index from the user table. return the number of users.'''
+        with self._lock:
+            self._changes = []
+        taken = None
+        try:
+            taken = self._load()
+        except SQLAlchemyError:
+            #e.g. no user table yet. lookups query the table until the next try
+            logger.warning('could not build the availability index', exc_info=True)
+        finally:
+            #whatever went wrong, the waiting lookups are let go
+            with self._lock:
+                if taken is not None:
+                    for field, old, new in self._changes:
+                        taken[field].discard(old)
+                        taken[field].add(new)
+                    self._taken = taken
+                    self._loaded = True
+                self._changes = None
+                self._built_at = time.time()
+                self._building = False
+            self._ready.set()
+        return len(taken['username']) if taken is not None else 0
+
+    def refresh(self):
+        ''' this is a function to start a rebuild in the background when the index is missing or older than AVAILABILITY_REFRESH.'''
+        with self._lock:
+            if self._building or time.time() - self._built_at < app.config['AVAILABILITY_REFRESH']:
+                return
+            self._building = True
+        threading.Thread(target=self.build, name='availability-index', daemon=True).start()
+
+    def is_taken(self, field, value):
+        ''' this is a function to check a username or email.
+
+        Args:
+            field: 'username' or 'email'
+            value: the text from the form
+
+        Return:
+            True if a user has it, compared normalized.
+        '''
+        self.refresh()
+        if not self._ready.wait(app.config['AVAILABILITY_WAIT']) or not self._loaded:
+            return self._query(field, value)
+        return normalize(value) in self._taken[field]
+
+    def _query(self, field, value):
+        #lower() of sqlite only folds ascii, close enough until the index is there
+        column = getattr(User, field)
+        query = db.select(User.id).where(func.lower(func.trim(column)) == normalize(value))
+        return db.session.execute(query.limit(1)).first() is not None
+
+    def replace(self, field, old, new):
+        ''' this is a function to record a new username or email after the commit. old is None for a new user.'''
+        old, new = normalize(old) if old is not None else None, normalize(new)
+        with self._lock:
+            self._taken[field].discard(old)
+            self._taken[field].add(new)
+            if self._changes is not None:
+                self._changes.append((field, old, new))
+
+
+index = AvailabilityIndex()
+
+
+#build the index as soon as the app serves, without holding up that request
+@app.before_request
+def _warm_index():
+    index.refresh()
+
+
+def conflicts(username, email, user_id=None):
+    ''' this is a function to find which of a username and email another user already has, after the
+    unique constraints refused a commit the index let through.
+
+    Args:
+        username, email: the values that were committed
+        user_id: the user that tried to take them, None for a new user
+
+    Return:
+        the list of the taken fields. they are added to the index too.
+    '''
+    taken = []
+    for field, value in (('username', username), ('email', email)):
+        column = getattr(User, field)
+        query = db.select(User.id).where(column == value)
+        if user_id is not None:
+            query = query.where(User.id != user_id)
+        if db.session.execute(query.limit(1)).first() is not None:
+            index.replace(field, None, value)
+            taken.append(field)
+    return taken
@@ -0,0 +1,242 @@
+'''profile picture processing, run as background jobs outside the request'''
+import io
+import json
+import os
+import threading
+from functools import lru_cache
+from PIL import Image
+from flask import url_for
+from sqlalchemy import event
+import time
+from flaskblog import app, db, cache, storage, metrics, jobs
+from flaskblog.database import RoutingSession
+from flaskblog.models import User, Job, forget_user
+
+app.config.setdefault('AVATAR_SIZES', (32, 64, 125, 250))
+app.config.setdefault('AVATAR_MAX_BYTES', 5 * 1024 * 1024)
+#werkzeug refuses larger requests with 413 before it reads them, instead of spooling the whole body for
+#check_upload. the rest is room for the other fields of the account form
+app.config.setdefault('MAX_CONTENT_LENGTH', app.config['AVATAR_MAX_BYTES'] + 64 * 1024)
+app.config.setdefault('AVATAR_MAX_PIXELS', 4096 * 4096)
+#uploads waiting for a worker, at most. they are kept in AVATAR_SPOOL_DIR until they are processed
+app.config.setdefault('AVATAR_QUEUE_SIZE', 16)
+app.config.setdefault('AVATAR_SPOOL_DIR', os.path.join(app.instance_path, 'uploads'))
+
+#PIL refuses to decode anything larger, whatever the caller checked before
+Image.MAX_IMAGE_PIXELS = app.config['AVATAR_MAX_PIXELS']
+
+#User.image_file is the 125px jpeg <name>.jpg, the other renditions are <name>_<size>.<jpg|webp>.
+#name is the content address of the upload given by flaskblog/storage.py, e.g. 3f/a2/3fa2...
+PRIMARY_SIZE = 125
+FORMATS = (('jpg', 'JPEG', {'quality': 85, 'optimize': True}), ('webp', 'WEBP', {'quality': 80, 'method': 4}))
+
+class AvatarBusy(Exception):
+    '''this is raised when the avatar queue is full.'''
+
+
+def too_large_message():
+    return 'The picture must be smaller than %d MB.' % (app.config['AVATAR_MAX_BYTES'] // (1024 * 1024))
+
+
+def rendition_name(name, size, ext):
+    ''' this is a function to get the file name of a rendition. name is the file name without extension.'''
+    if size == PRIMARY_SIZE and ext == 'jpg':
+        return name + '.jpg'
+    return '%s_%d.%s' % (name, size, ext)
+
+
+#check the upload without decoding it. only the header is read.
+def check_upload(form_picture):
+    ''' this is a function to guard against oversized uploads and decompression bombs.
+
+    Args:
+        form_picture: the uploaded file from the form
+
+    Return:
+        the bytes of the upload. raise ValueError with a message for the user if it is too large or not an image.
+    '''
+    data = form_picture.read(app.config['AVATAR_MAX_BYTES'] + 1)
+    form_picture.seek(0)
+    if len(data) > app.config['AVATAR_MAX_BYTES']:
+        raise ValueError(too_large_message())
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+    except (Image.DecompressionBombError, OSError, SyntaxError):
+        raise ValueError('That file is not a picture we can read.')
+    if width * height > app.config['AVATAR_MAX_PIXELS']:
+        raise ValueError('The picture must have fewer than %d pixels.' % app.config['AVATAR_MAX_PIXELS'])
+    return data
+
+
+#decode once at the largest size needed, then write every rendition
+def render_renditions(data, name):
+    ''' this is a function to write the renditions of an avatar.
+
+    Args:
+        data: bytes of the upload
+        name: storage name without extension
+
+    Return:
+        the primary file name, <name>.jpg
+    '''
+    start = time.perf_counter()
+    sizes = sorted(app.config['AVATAR_SIZES'])
+    image = Image.open(io.BytesIO(data))
+    #jpeg can be decoded at 1/2, 1/4 or 1/8 scale, which is much cheaper than a full decode
+    image.draft('RGB', (sizes[-1], sizes[-1]))
+    if image.mode in ('RGBA', 'LA', 'P'):
+        #put transparent pictures on white instead of letting jpeg turn them black
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    else:
+        image = image.convert('RGB')
+    storage.make_dirs(name)
+    #write every file under a temp name first, so a rendition never exists without the others
+    suffix = '.%d-%d.tmp' % (os.getpid(), threading.get_ident())
+    written = []
+    for size in reversed(sizes):
+        image.thumbnail((size, size))
+        for ext, fmt, options in FORMATS:
+            path = storage.path_of(rendition_name(name, size, ext))
+            image.save(path + suffix, fmt, **options)
+            written.append(path)
+    for path in written:
+        os.replace(path + suffix, path)
+    metrics.image_seconds.observe(time.perf_counter() - start)
+    return name + '.jpg'
+
+
+#the upload waits here for its job. named like the renditions, so identical uploads share the file
+def spool_path(name):
+    ''' this is a function to get the path of the spooled upload of a storage name.'''
+    return os.path.join(app.config['AVATAR_SPOOL_DIR'], name.rsplit('/', 1)[-1] + '.upload')
+
+
+@jobs.handler('avatar')
+def process(payload):
+    ''' this is a job to write the renditions of an upload and give them to the user.
+
+    Args:
+        payload: {'name': storage name of the upload, 'user_id': the owner}
+
+    '''
+    name, user_id = payload['name'], payload['user_id']
+    #an identical picture was uploaded before, reuse its renditions
+    if storage.exists(name + '.jpg'):
+        picture_fn = name + '.jpg'
+    else:
+        with open(spool_path(name), 'rb') as upload:
+            picture_fn = render_renditions(upload.read(), name)
+    User.query.filter_by(id=user_id).update({'image_file': picture_fn})
+    db.session.commit()
+    forget_user(user_id)
+    #'authors' is part of the ETag of the feeds, which show the pictures of many users
+    cache.invalidate('user:%d' % user_id, 'authors')
+    try:
+        os.remove(spool_path(name))
+    except OSError:
+        pass
+
+
+#queue the upload for processing. the user keeps the old picture until it is done.
+def submit(data, user_id):
+    ''' this is a function to process an avatar in the background.
+
+    Args:
+        data: bytes returned by check_upload
+        user_id: the user the picture belongs to. User.image_file is updated when the renditions are written
+
+    Return:
+        True if a job was queued, False if the same picture was waiting already. it runs once the session
+        is committed, a rollback removes the spooled upload again. raise AvatarBusy if AVATAR_QUEUE_SIZE
+        uploads are waiting.
+    '''
+    waiting = db.session.query(db.func.count(Job.id)).filter(Job.kind == 'avatar', Job.state == 'queued').scalar()
+    if waiting >= app.config['AVATAR_QUEUE_SIZE']:
+        raise AvatarBusy()
+    name = storage.content_name(data)
+    if storage.exists(name + '.jpg'):
+        #the job reuses them. no user points at them yet, so they look orphaned to gc-pictures until then
+        touch_renditions(name)
+    else:
+        path = spool_path(name)
+        #a spooled file that is there already belongs to the queued job of an identical upload, a rollback keeps it
+        if not os.path.exists(path):
+            db.session.info.setdefault('avatars_spooled', []).append(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = '%s.%d-%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(temp, 'wb') as upload:
+            upload.write(data)
+        os.replace(temp, path)
+    return jobs.enqueue('avatar', {'name': name, 'user_id': user_id})
+
+
+def touch_renditions(name):
+    ''' this is a function to set the modification time of the renditions of a storage name to now.'''
+    for size in app.config['AVATAR_SIZES']:
+        for ext, _, _ in FORMATS:
+            try:
+                os.utime(storage.path_of(rendition_name(name, size, ext)))
+            except OSError:
+                pass
+
+
+#the pictures gc-pictures has to keep although no user points at them yet
+def pending_pictures():
+    ''' this is a function to list the primary file names, <name>.jpg, of the avatar jobs in the queue, failed ones included.'''
+    return set(json.loads(payload)['name'] + '.jpg' for payload, in
+               db.session.query(Job.payload).filter(Job.kind == 'avatar'))
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _keep_after_commit(session):
+    session.info.pop('avatars_spooled', None)
+
+
+#the job was rolled back with the change that needed it, nothing would ever read its upload
+@event.listens_for(RoutingSession, 'after_rollback')
+def _remove_after_rollback(session):
+    for path in session.info.pop('avatars_spooled', ()):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+#file names are content addresses, so the answer for a name never changes once it is referenced by a user
+@app.template_global()
+@lru_cache(maxsize=4096)
+def has_renditions(image_file):
+    ''' this is a function to check if an avatar was processed into renditions. old and default pictures were not.'''
+    name, _ = os.path.splitext(image_file)
+    return storage.exists(rendition_name(name, PRIMARY_SIZE, 'webp'))
+
+
+#url of one rendition of an avatar
+@app.template_global()
+def avatar_url(image_file, size=PRIMARY_SIZE, ext='jpg'):
+    ''' this is a function for the templates to get the url of an avatar rendition.
+
+    Args:
+        image_file: User.image_file
+        size: one of AVATAR_SIZES
+        ext: 'jpg' or 'webp'
+
+    Return:
+        the url of the rendition. pictures without renditions return the original file.
+    '''
+    if not has_renditions(image_file):
+        return url_for('static', filename='profile_pics/' + image_file)
+    name, _ = os.path.splitext(image_file)
+    return url_for('static', filename='profile_pics/' + rendition_name(name, size, ext))
+
+
+#srcset with a 1x and a 2x rendition for hi-dpi screens
+@app.template_global()
+def avatar_srcset(image_file, size, ext='webp'):
+    ''' this is a function for the templates to get the srcset of an avatar shown at size css pixels.'''
+    double = min(app.config['AVATAR_SIZES'], key=lambda s: abs(s - size * 2))
+    return '%s 1x, %s 2x' % (avatar_url(image_file, size, ext), avatar_url(image_file, double, ext))
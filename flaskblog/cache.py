@@ -0,0 +1,335 @@
+'''rendered page cache with an in-process LRU backend and a filesystem backend'''
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from flask import session
+
+
+class NullBackend(object):
+    '''this is a backend that stores nothing. use CACHE_TYPE = 'null' to turn the cache off.'''
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUBackend(object):
+    '''this is an in-process cache. each worker process has its own copy.
+
+    Args:
+        max_entries: evict the least recently used entries above this number
+        max_bytes: evict the least recently used entries above this total size
+        default_timeout: seconds an entry lives. 0 means forever
+
+    '''
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, default_timeout=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires and expires < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        expires = time.time() + timeout if timeout else 0
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires, value)
+            self._bytes += len(value)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+
+class FileSystemBackend(object):
+    '''this is a cache stored as one file per entry. all worker processes on the host share it.
+
+    Args:
+        cache_dir: the directory of the cache files
+        max_entries: prune expired, then oldest files above this number
+        default_timeout: seconds an entry lives. 0 means forever
+
+    '''
+
+    def __init__(self, cache_dir, max_entries=10000, default_timeout=300):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._writes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires = float(f.readline())
+                if expires and expires < time.time():
+                    return None
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        expires = time.time() + timeout if timeout else 0
+        #write to a temp file and rename, so readers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(('%r\n' % expires).encode('ascii'))
+            f.write(value)
+        os.replace(tmp, self._path(key))
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            self.delete_file(entry.path)
+
+    def prune(self):
+        ''' this is a function to drop expired files, then the oldest ones above max_entries.'''
+        now = time.time()
+        alive = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                with open(entry.path, 'rb') as f:
+                    expires = float(f.readline())
+                mtime = entry.stat().st_mtime
+            except (OSError, ValueError):
+                continue
+            if expires and expires < now:
+                self.delete_file(entry.path)
+            else:
+                alive.append((mtime, entry.path))
+        alive.sort()
+        for _, path in alive[:max(len(alive) - self.max_entries, 0)]:
+            self.delete_file(path)
+
+    @staticmethod
+    def delete_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Cache(object):
+    '''this is the cache used by the routes. entries carry tags, and invalidating a tag drops every entry that has it.
+
+    Every tag has a random version stored in the backend. An entry remembers the versions of its tags
+    when it is stored, and is a miss when any of them changed. So invalidation works across processes
+    with the filesystem backend, and an evicted version can only cause a miss, never a stale hit.
+    A version also holds the time it was made, the Last-Modified of what the tag stands for. page and
+    stream do not store what they rendered if one of its tags was invalidated while it was rendering.
+
+    Config:
+        CACHE_TYPE: 'lru' (default), 'filesystem' or 'null'
+        CACHE_DEFAULT_TIMEOUT: seconds an entry lives
+        CACHE_MAX_ENTRIES: max number of entries
+        CACHE_MAX_BYTES: max total size of the lru backend
+        CACHE_DIR: directory of the filesystem backend
+        another cache made with config_prefix='X' reads X_TYPE, X_DEFAULT_TIMEOUT and so on
+
+    '''
+
+    def __init__(self, app=None, config_prefix='CACHE'):
+        self.config_prefix = config_prefix
+        self.backend = NullBackend()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        #a second cache reads the same settings under its own prefix, e.g. IDENTITY_CACHE_TYPE
+        prefix = self.config_prefix + '_'
+        config = app.config
+        config.setdefault(prefix + 'TYPE', 'lru')
+        config.setdefault(prefix + 'DEFAULT_TIMEOUT', 300)
+        config.setdefault(prefix + 'MAX_ENTRIES', 1000)
+        config.setdefault(prefix + 'MAX_BYTES', 16 * 1024 * 1024)
+        config.setdefault(prefix + 'DIR', os.path.join(app.instance_path, self.config_prefix.lower()))
+        cache_type = config[prefix + 'TYPE']
+        if cache_type == 'lru':
+            self.backend = LRUBackend(config[prefix + 'MAX_ENTRIES'], config[prefix + 'MAX_BYTES'],
+                                      config[prefix + 'DEFAULT_TIMEOUT'])
+        elif cache_type == 'filesystem':
+            self.backend = FileSystemBackend(config[prefix + 'DIR'], config[prefix + 'MAX_ENTRIES'],
+                                             config[prefix + 'DEFAULT_TIMEOUT'])
+        elif cache_type == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError('unknown %sTYPE %r' % (prefix, cache_type))
+
+    @staticmethod
+    def _now():
+        return int(time.time() * 1000000)
+
+    @classmethod
+    def _new_version(cls, made_at=None):
+        #16 random bytes, so two processes never make the same version, then the time in microseconds
+        return uuid.uuid4().bytes + struct.pack('>q', cls._now() if made_at is None else made_at)
+
+    @staticmethod
+    def _made_at(version):
+        #versions stored before they carried their time count as made at 0
+        return struct.unpack('>q', version[16:])[0] if len(version) == 24 else 0
+
+    def _version(self, tag, create=False, made_at=None):
+        version = self.backend.get('tag:' + tag)
+        if version is None and create:
+            version = self._new_version(made_at)
+            self.backend.set('tag:' + tag, version, timeout=0)
+        return version
+
+    def tag_version(self, tag):
+        ''' this is a function to get the current version of a tag as hex. it changes whenever the tag is invalidated.'''
+        return self._version(tag, create=True).hex()
+
+    def tag_changed_at(self, tag):
+        ''' this is a function to get when a tag was last invalidated, as a naive utc datetime.
+
+        Return:
+            the time its version was made. a version that was evicted, or never made, is made now,
+            which is later than the truth and so can only cost a full answer, never a stale 304.
+        '''
+        version = self._version(tag, create=True)
+        if len(version) != 24:
+            #a version stored before they carried their time
+            return datetime.utcnow()
+        return datetime(1970, 1, 1) + timedelta(microseconds=self._made_at(version))
+
+    def get(self, key):
+        ''' this is a function to read an entry. return None on a miss or if one of its tags was invalidated.'''
+        raw = self.backend.get('entry:' + key)
+        if raw is None:
+            return None
+        value, versions = pickle.loads(raw)
+        for tag, version in versions.items():
+            if self._version(tag) != version:
+                return None
+        return value
+
+    def set(self, key, value, tags=(), timeout=None, since=None):
+        ''' this is a function to store an entry.
+
+        Args:
+            key: the cache key
+            value: any picklable value
+            tags: the tags to invalidate the entry by, e.g. 'post:3'
+            timeout: seconds the entry lives. None uses CACHE_DEFAULT_TIMEOUT
+            since: time in microseconds, see _now, the value was made from the database at. None stores it anyway
+
+        Return:
+            False if a tag was invalidated after since, the value may be stale and is not stored. else True.
+        '''
+        #a tag without a version was not invalidated meanwhile, it gets one that is as old as the value
+        versions = dict((tag, self._version(tag, create=True, made_at=since)) for tag in set(tags))
+        if since is not None and any(self._made_at(version) > since for version in versions.values()):
+            return False
+        self.backend.set('entry:' + key, pickle.dumps((value, versions), pickle.HIGHEST_PROTOCOL), timeout)
+        return True
+
+    def delete(self, key):
+        self.backend.delete('entry:' + key)
+
+    def invalidate(self, *tags):
+        ''' this is a function to drop every entry that has one of the tags.'''
+        for tag in tags:
+            self.backend.set('tag:' + tag, self._new_version(), timeout=0)
+
+    def clear(self):
+        self.backend.clear()
+
+    def page(self, key, render):
+        ''' this is a function to serve a rendered page from the cache.
+
+        Args:
+            key: the cache key. it must contain everything the page depends on (route, page / cursor, view)
+            render: function returning (html, tags) on a miss
+
+        Return:
+            the html. pages with pending flash messages are neither read from nor written to the cache.
+        '''
+        if session.get('_flashes'):
+            return render()[0]
+        html = self.get(key)
+        if html is None:
+            #taken before render reads the database, a writer that commits meanwhile invalidates after it
+            since = self._now()
+            html, tags = render()
+            self.set(key, html, tags, since=since)
+        return html
+
+    def stream(self, key, generate):
+        ''' this is a function to serve a streamed body from the cache.
+
+        Args:
+            key: the cache key
+            generate: function taking a list and returning a generator of text chunks. it appends
+                the tags of what it wrote to the list
+
+        Return:
+            a generator of the text. on a miss the chunks are passed on as they are made,
+            and stored together once the last one is done.
+        '''
+        body = self.get(key)
+        if body is not None:
+            yield body
+            return
+        tags, chunks = [], []
+        since = self._now()
+        for chunk in generate(tags):
+            chunks.append(chunk)
+            yield chunk
+        self.set(key, ''.join(chunks), tags, since=since)
@@ -0,0 +1,301 @@
+'''flask command line tools. run them with "flask blog <command>" after setting FLASK_APP=run.py'''
+import os
+import signal
+import threading
+import time
+from datetime import datetime
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, inspect, text
+from werkzeug.serving import make_server
+from flaskblog import app, db, cache, storage, search, transfer, excerpts, rendering, assets, stats, jobs, metrics, avatars
+from flaskblog.models import User, Post, Job
+
+blog_cli = AppGroup('blog', help='Maintenance commands for the blog database.')
+
+
+#posts written before there was an updated_at were last changed when they were posted, as far as we know
+def fill_updated_at():
+    ''' this is a function to set the missing post.updated_at to date_posted. return the number of posts changed.'''
+    with db.engine.begin() as conn:
+        return conn.execute(text('UPDATE post SET updated_at = date_posted WHERE updated_at IS NULL')).rowcount
+
+
+#create missing tables, columns and indexes on an existing database. safe to run many times.
+@blog_cli.command('upgrade-db')
+def upgrade_db():
+    ''' this is a command to bring an existing site.db up to date with the models.
+
+    Return:
+        create the missing tables via db.create_all.
+        add the columns and indexes that were added to the models after the table was created.
+    '''
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            #sqlite can only add columns that are nullable or have a constant default
+            ddl = column.type.compile(dialect=db.engine.dialect)
+            sql = 'ALTER TABLE "%s" ADD COLUMN "%s" %s' % (table.name, column.name, ddl)
+            if column.server_default is not None:
+                default = column.server_default.arg
+                sql += ' DEFAULT %s' % getattr(default, 'text', "'%s'" % default)
+            with db.engine.begin() as conn:
+                conn.execute(text(sql))
+            click.echo('added column %s.%s' % (table.name, column.name))
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        if search.create_index(conn):
+            click.echo('search index is in place. run flask blog reindex-search if posts were written without it')
+    stale = db.session.query(func.count(User.id)).filter(
+        User.post_count == 0, db.session.query(Post.id).filter(Post.user_id == User.id).exists()).scalar()
+    if stale:
+        click.echo('%d users with posts have no post_count. run flask blog reconcile-stats' % stale)
+    filled = fill_updated_at()
+    if filled:
+        click.echo('set updated_at of %d posts to their date_posted' % filled)
+    missing = db.session.query(func.count(Post.id)).filter(Post.excerpt.is_(None)).scalar()
+    if missing:
+        click.echo('%d posts have no excerpt. run flask blog backfill-excerpts' % missing)
+    outdated = db.session.query(func.count(Post.id)).filter(
+        (Post.renderer_version != rendering.RENDERER_VERSION) | Post.renderer_version.is_(None)).scalar()
+    if outdated:
+        click.echo('%d posts were not rendered by %s. run flask blog rerender-posts' % (outdated, rendering.RENDERER_VERSION))
+    click.echo('database is up to date')
+
+
+#delete the pictures no user points to any more, a batch of files at a time
+@blog_cli.command('gc-pictures')
+@click.option('--batch-size', default=500, show_default=True, help='Files checked per query.')
+@click.option('--min-age', default=3600, show_default=True, help='Keep files younger than this many seconds.')
+@click.option('--dry-run', is_flag=True, help='Only list the files that would be deleted.')
+def gc_pictures(batch_size, min_age, dry_run):
+    ''' this is a command to remove orphaned profile pictures.
+
+    Args:
+        batch_size: number of files looked up in User.image_file with one query
+        min_age: files of uploads still being processed are younger than this, and are kept
+        dry_run: do not delete anything
+
+    Return:
+        walk static/profile_pics lazily. delete every file that neither it nor its primary rendition
+        is the image_file of a user or of an avatar job in the queue. print the number of files deleted.
+    '''
+    #renditions a queued job is going to give to its user, see avatars.submit
+    pending = avatars.pending_pictures()
+
+    def collect(batch):
+        names = set()
+        for rel_path in batch:
+            names |= storage.referenced_as(rel_path)
+        referenced = set(row[0] for row in
+                         db.session.query(User.image_file).filter(User.image_file.in_(names)))
+        removed = 0
+        for rel_path in batch:
+            if storage.referenced_as(rel_path) & (referenced | pending):
+                continue
+            if dry_run:
+                click.echo(rel_path)
+            else:
+                try:
+                    os.remove(storage.path_of(rel_path))
+                except OSError:
+                    continue
+            removed += 1
+        return removed
+
+    removed = 0
+    batch = []
+    for rel_path in storage.iter_files(min_age):
+        batch.append(rel_path)
+        if len(batch) >= batch_size:
+            removed += collect(batch)
+            batch = []
+    if batch:
+        removed += collect(batch)
+    click.echo('%s %d orphaned files' % ('would delete' if dry_run else 'deleted', removed))
+
+
+#fingerprint and precompress the static files, run it on every deploy
+@blog_cli.command('build-assets')
+@click.option('--clean', is_flag=True, help='Delete built files the new manifest does not list.')
+def build_assets(clean):
+    ''' this is a command to build static/dist and its manifest. restart the app to load the new manifest.'''
+    files = assets.build(clean)
+    for name, entry in sorted(files.items()):
+        click.echo('%s -> %s %s' % (name, entry['path'], ' '.join(entry['encodings'])))
+    click.echo('built %d files%s' % (len(files), '' if assets.brotli is not None else ', no brotli installed'))
+
+
+#rebuild the full-text index from the post table
+@blog_cli.command('reindex-search')
+@click.option('--batch-size', default=1000, show_default=True, help='Posts indexed per transaction.')
+def reindex_search(batch_size):
+    ''' this is a command to rebuild the FTS5 index of the posts in batches, e.g. for a database made before search.'''
+    done = 0
+    for done in search.rebuild_index(batch_size):
+        click.echo('indexed %d posts' % done)
+    click.echo('search index rebuilt, %d posts' % done)
+
+
+#compute the excerpts of the posts written before there were excerpts
+@blog_cli.command('backfill-excerpts')
+@click.option('--batch-size', default=1000, show_default=True, help='Posts updated per transaction.')
+@click.option('--all', 'rewrite', is_flag=True, help='Recompute every excerpt, not only the missing ones.')
+def backfill_excerpts(batch_size, rewrite):
+    ''' this is a command to fill post.excerpt in batches, e.g. after upgrade-db added the column.'''
+    done = 0
+    for done in excerpts.backfill_excerpts(batch_size, rewrite):
+        click.echo('updated %d posts' % done)
+    cache.clear()
+    click.echo('excerpts done, %d posts' % done)
+
+
+#render the posts again after RENDERER_VERSION changed, e.g. markdown or nh3 was upgraded
+@blog_cli.command('rerender-posts')
+@click.option('--batch-size', default=500, show_default=True, help='Posts rendered per transaction.')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True, help='Rendering processes.')
+@click.option('--all', 'rewrite', is_flag=True, help='Render every post, not only the outdated ones.')
+def rerender_posts(batch_size, workers, rewrite):
+    ''' this is a command to refresh post.content_html and post.excerpt of the posts rendered by another renderer version.'''
+    start = time.perf_counter()
+    done = 0
+    for done in rendering.rerender_posts(batch_size, workers, rewrite):
+        click.echo('rendered %d posts (%d posts/sec)' % (done, done / max(time.perf_counter() - start, 1e-6)))
+    cache.clear()
+    click.echo('posts rendered with %s, %d updated' % (rendering.RENDERER_VERSION, done))
+
+
+#recompute post_count, last_post_at and content_bytes of every user from the posts
+@blog_cli.command('reconcile-stats')
+@click.option('--batch-size', default=1000, show_default=True, help='Users recomputed per transaction.')
+def reconcile_stats(batch_size):
+    ''' this is a command to rebuild the author statistics, e.g. after upgrade-db added them or rows were changed by hand.'''
+    done = 0
+    for done in stats.reconcile_all(batch_size):
+        click.echo('recomputed %d users' % done)
+    cache.clear()
+    click.echo('author statistics rebuilt, %d users' % done)
+
+
+#dump users and posts as JSON lines
+@blog_cli.command('export')
+@click.argument('path')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows read per query.')
+def export_data(path, batch_size):
+    ''' this is a command to export the blog to PATH. '-' writes to stdout, a name ending in .gz is gzipped.'''
+    start = time.perf_counter()
+    count = 0
+    with transfer.open_file(path, 'w') as f:
+        for count in transfer.export_rows(f, batch_size):
+            pass
+    elapsed = time.perf_counter() - start
+    click.echo('exported %d rows in %.1fs (%d rows/sec)' % (count, elapsed, count / max(elapsed, 1e-6)), err=True)
+
+
+#load users and posts written by flask blog export
+@blog_cli.command('import')
+@click.argument('path')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows per executemany and per transaction.')
+@click.option('--reindex/--no-reindex', default=True, show_default=True,
+              help='Drop the search triggers during the import and rebuild the index once at the end.')
+def import_data(path, batch_size, reindex):
+    ''' this is a command to import PATH into the database. '-' reads stdin, a name ending in .gz is gunzipped.
+
+    Return:
+        insert the rows with their ids in batches. password hashes are copied, not hashed again.
+        print the throughput in rows/sec.
+    '''
+    start = time.perf_counter()
+    count = 0
+    if reindex:
+        with db.engine.begin() as conn:
+            for trigger in ('post_fts_insert', 'post_fts_update', 'post_fts_delete'):
+                conn.execute(text('DROP TRIGGER IF EXISTS %s' % trigger))
+    try:
+        with transfer.open_file(path, 'r') as f:
+            for count in transfer.import_rows(f, batch_size):
+                elapsed = time.perf_counter() - start
+                click.echo('imported %d rows (%d rows/sec)' % (count, count / max(elapsed, 1e-6)))
+    finally:
+        if reindex:
+            for indexed in search.rebuild_index():
+                pass
+    #files exported before there were excerpts, or by another renderer
+    fill_updated_at()
+    #the rows were inserted without the orm, which keeps the author statistics
+    for updated in stats.reconcile_all():
+        pass
+    for updated in excerpts.backfill_excerpts(batch_size):
+        pass
+    for updated in rendering.rerender_posts(workers=os.cpu_count() or 1):
+        pass
+    cache.clear()
+    elapsed = time.perf_counter() - start
+    click.echo('imported %d rows in %.1fs (%d rows/sec)' % (count, elapsed, count / max(elapsed, 1e-6)))
+
+
+#show the job queue, and hand the failed jobs back to the workers
+@blog_cli.command('jobs')
+@click.option('--retry', is_flag=True, help='Queue the failed jobs again.')
+@click.option('--purge', is_flag=True, help='Delete the failed jobs.')
+def show_jobs(retry, purge):
+    ''' this is a command to count the jobs by kind and state and print the last error of every failed job.'''
+    failed = Job.query.filter_by(state='failed')
+    if retry:
+        #a failed job whose twin is queued again is not needed any more
+        queued = db.session.query(Job.dedupe_key).filter(Job.state == 'queued', Job.dedupe_key.isnot(None))
+        failed.filter(Job.dedupe_key.in_(queued)).delete(synchronize_session=False)
+        count = failed.update({'state': 'queued', 'attempts': 0, 'run_at': datetime.utcnow()},
+                              synchronize_session=False)
+        db.session.commit()
+        click.echo('queued %d failed jobs again' % count)
+    elif purge:
+        count = failed.delete(synchronize_session=False)
+        db.session.commit()
+        click.echo('deleted %d failed jobs' % count)
+    for kind, state, count in db.session.query(Job.kind, Job.state, func.count(Job.id)).group_by(Job.kind, Job.state):
+        click.echo('%-12s %-8s %d' % (kind, state, count))
+    for job in failed.order_by(Job.id):
+        click.echo('\njob %d %s %s, %d attempts\n%s' % (job.id, job.kind, job.payload, job.attempts, job.last_error))
+
+
+app.cli.add_command(blog_cli)
+
+
+#run the background jobs, e.g. "flask worker --workers 4". stop it with ctrl-c or SIGTERM, the running jobs are finished first
+@app.cli.command('worker')
+@click.option('--workers', default=None, type=int, help='Worker threads. default JOBS_WORKERS.')
+@click.option('--burst', is_flag=True, help='Exit once no job is due.')
+@click.option('--metrics-port', default=None, type=int, help='Serve /metrics of the workers on this port.')
+def worker(workers, burst, metrics_port):
+    ''' this is a command to run the jobs queued by the app, see flaskblog/jobs.py.
+
+    Return:
+        run JOBS_WORKERS threads that claim due jobs from the job table, retry the failed ones with backoff
+        and give up after JOBS_MAX_ATTEMPTS. set JOBS_IN_APP = False in the app when this runs.
+    '''
+    #the warm-feeds jobs send requests to the app, they must not start in-app workers in this process
+    app.config['JOBS_IN_APP'] = False
+    if metrics_port:
+        server = make_server('0.0.0.0', metrics_port, metrics.metrics_app, threaded=True)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        click.echo('metrics on port %d' % metrics_port)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    threads = jobs.start(workers or app.config['JOBS_WORKERS'], stop, burst=burst)
+    click.echo('%d workers running %s' % (len(threads), ', '.join(sorted(jobs.handlers))))
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        click.echo('finishing the running jobs')
+        stop.set()
+        for thread in threads:
+            thread.join()
+    click.echo('workers stopped')
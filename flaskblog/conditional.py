@@ -0,0 +1,81 @@
+'''conditional GET: ETag / Last-Modified validators, 304 answers and the Cache-Control of the pages'''
+import hashlib
+from flask import make_response, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+from flaskblog import cache
+
+
+def make_etag(*parts):
+    ''' this is a function to turn everything a page depends on into an ETag value.'''
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:32]
+
+
+#deleted posts, renamed authors and new pictures change a page without a newer post.updated_at
+def last_change(updated_at, *tags):
+    ''' this is a function to get the Last-Modified of a page.
+
+    Args:
+        updated_at: the newest post.updated_at on the page, or None
+        tags: the cache tags the page is invalidated by, e.g. 'feed' and 'authors'
+
+    Return:
+        the later of updated_at and the last invalidation of the tags.
+    '''
+    times = [cache.tag_changed_at(tag) for tag in tags]
+    if updated_at is not None:
+        times.append(updated_at)
+    return max(times) if times else None
+
+
+def cache_control(response, public=None):
+    ''' this is a function to set Cache-Control and Vary on a page.
+
+    Args:
+        response: the page
+        public: True lets shared caches (our proxy) keep the page. default: only for anonymous users
+
+    Return:
+        the response. pages are always revalidated, logged in pages only by the browser.
+    '''
+    if public is None:
+        public = not current_user.is_authenticated
+    response.cache_control.no_cache = None
+    if public:
+        response.cache_control.public = True
+        response.cache_control.max_age = 0
+        response.cache_control.must_revalidate = True
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    #the same url is a different page with another session cookie
+    response.vary.add('Cookie')
+    return response
+
+
+#answer 304 when the browser's copy is still current, else render the page
+def conditional_page(etag, last_modified, render, public=None):
+    ''' this is a function to serve a page with validators.
+
+    Args:
+        etag: value from make_etag, it must change whenever the page does
+        last_modified: naive utc datetime of the last change, or None
+        render: function returning the html, only called when the page is sent
+        public: see cache_control
+
+    Return:
+        an empty 304 response if If-None-Match / If-Modified-Since match, else the rendered page.
+        pages with pending flash messages are always rendered and never stored.
+    '''
+    if session.get('_flashes'):
+        response = make_response(render())
+        response.cache_control.no_store = True
+        return response
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return cache_control(response, public)
@@ -0,0 +1,74 @@
+'''config profiles of the app, chosen with the FLASKBLOG_CONFIG environment variable'''
+import os
+
+
+class Config(object):
+    '''this is the base profile, the settings shared by every profile.
+
+    Attributes:
+        SQLITE_PRAGMAS: PRAGMA name -> value, run on every new connection of the database
+        SQLALCHEMY_READ_ENGINE: True gives the read only routes their own engine and connection pool,
+            see flaskblog.database.read_only
+        SQLALCHEMY_READ_ENGINE_OPTIONS: create_engine options of the read engine
+
+    '''
+    SECRET_KEY = os.environ.get('SECRET_KEY', '5791628bb0b13ce0c676dfde280ba245')
+    #DATABASE_URL points the app at another database, e.g. the synthetic ones of the benchmarks.
+    #the default is flaskblog/site.db by its full path: flask-sqlalchemy 3 puts relative sqlite paths in instance/
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'DATABASE_URL', 'sqlite:///' + os.path.join(os.path.dirname(os.path.abspath(__file__)), 'site.db'))
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    SQLITE_PRAGMAS = {'busy_timeout': 5000}
+    SQLALCHEMY_READ_ENGINE = False
+    SQLALCHEMY_READ_ENGINE_OPTIONS = {}
+
+
+class DevelopmentConfig(Config):
+    '''this is the default profile, one engine with the sqlite defaults.'''
+
+
+class ProductionConfig(Config):
+    '''this is the profile of a server with many concurrent requests.
+
+    WAL lets the readers go on while one writer commits, so new_post and account no longer
+    lock the home page. synchronous=NORMAL is safe with WAL and saves an fsync per commit.
+    The page and identity caches are files under instance/, shared by every worker process.
+    '''
+    #every pooled connection may be used by another request thread than the one that opened it
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 10,
+        'max_overflow': 10,
+        'pool_timeout': 10,
+        'pool_recycle': 3600,
+        'connect_args': {'timeout': 15, 'check_same_thread': False},
+    }
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 15000,
+        #negative is KiB, so 16MB of page cache per connection
+        'cache_size': -16000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    }
+    SQLALCHEMY_READ_ENGINE = True
+    #the worker processes share the caches, so an invalidation or forget_user in one reaches all of
+    #them, and every worker answers with the same tag versions and so the same ETags
+    CACHE_TYPE = 'filesystem'
+    IDENTITY_CACHE_TYPE = 'filesystem'
+    #url_for('static') points at the files built by flask blog build-assets
+    ASSETS_FINGERPRINT = True
+    SQLALCHEMY_READ_ENGINE_OPTIONS = {
+        'pool_size': 20,
+        'max_overflow': 20,
+        'pool_timeout': 10,
+        'pool_recycle': 3600,
+        'connect_args': {'timeout': 15, 'check_same_thread': False},
+    }
+
+
+profiles = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+}
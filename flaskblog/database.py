@@ -0,0 +1,70 @@
+'''sqlite connection settings and the routing of read only views to their own engine'''
+from functools import partial, wraps
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+#the bind key of the read engine in SQLALCHEMY_BINDS
+READ_BIND = 'read'
+
+
+class RoutingSession(Session):
+    '''this is db.session. inside a view marked with read_only, and while nothing is flushed,
+    queries go to the read engine instead of the default one.'''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_request_context() and g.get('read_only')
+                and READ_BIND in self._db.engines):
+            return self._db.engines[READ_BIND]
+        return super(RoutingSession, self).get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+#mark a view that never writes. put it below @app.route
+def read_only(view):
+    ''' this is a function to send the queries of a view to the read engine, if there is one.'''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+def read_engine_bind(config):
+    ''' this is a function to build the SQLALCHEMY_BINDS entry of the read engine.
+
+    Args:
+        config: the app config
+
+    Return:
+        create_engine options with the url. it is the same database as SQLALCHEMY_DATABASE_URI,
+        in its own connection pool whose connections can not write.
+    '''
+    return dict(config['SQLALCHEMY_READ_ENGINE_OPTIONS'], url=config['SQLALCHEMY_DATABASE_URI'])
+
+
+def configure_engines(app, db):
+    ''' this is a function to run SQLITE_PRAGMAS on every new sqlite connection of the app.
+
+    Args:
+        app: the flask app
+        db: its SQLAlchemy object
+
+    '''
+    with app.app_context():
+        engines = dict(db.engines)
+    for key, engine in engines.items():
+        if engine.dialect.name != 'sqlite':
+            continue
+        pragmas = list(app.config['SQLITE_PRAGMAS'].items())
+        if key == READ_BIND:
+            #the journal mode is the writer's business. query_only turns any write into an error
+            pragmas = [(name, value) for name, value in pragmas if name != 'journal_mode']
+            pragmas.append(('query_only', 'ON'))
+        event.listen(engine, 'connect', partial(_set_pragmas, pragmas))
@@ -0,0 +1,65 @@
+'''short plain text excerpts of the posts, stored next to the content for the list pages'''
+from html import unescape
+import nh3
+from sqlalchemy import event
+from flaskblog import db
+from flaskblog.models import Post
+
+EXCERPT_LENGTH = 280
+
+
+#the text a reader sees, so no markdown syntax like ** or [](...) ends up in the excerpt
+def make_excerpt(content_html, length=EXCERPT_LENGTH):
+    ''' this is a function to cut the start of a post down to an excerpt.
+
+    Args:
+        content_html: the rendered post, see flaskblog/rendering.py
+        length: max characters before the '...'
+
+    Return:
+        the text of the html with its whitespace collapsed, cut at the last word that fits.
+    '''
+    text = ' '.join(unescape(nh3.clean(content_html or '', tags=set())).split())
+    if len(text) <= length:
+        return text
+    cut = text.rfind(' ', 0, length + 1)
+    #one very long word: cut inside it rather than show almost nothing
+    if cut < length // 2:
+        cut = length
+    return text[:cut].rstrip(' .,;:') + '...'
+
+
+#new_post, update_post and anything else that sets post.content render it, which keeps the excerpt in step
+@event.listens_for(Post.content_html, 'set')
+def _update_excerpt(post, value, oldvalue, initiator):
+    post.excerpt = make_excerpt(value)
+
+
+#fill the excerpt of the posts that have none, batch_size posts per transaction
+def backfill_excerpts(batch_size=1000, rewrite=False):
+    ''' this is a function to compute the excerpts of existing posts.
+
+    Args:
+        batch_size: posts read and updated per transaction
+        rewrite: also recompute the posts that already have an excerpt, e.g. after EXCERPT_LENGTH changed
+
+    Return:
+        a generator of the number of posts updated so far, one value per batch. posts without
+        content_html are left to flask blog rerender-posts, which writes both.
+    '''
+    table = Post.__table__
+    update = table.update().where(table.c.id == db.bindparam('post_id')).values(excerpt=db.bindparam('new_excerpt'))
+    last_id, done = 0, 0
+    while True:
+        with db.engine.begin() as conn:
+            query = db.select(table.c.id, table.c.content_html).where(
+                table.c.id > last_id, table.c.content_html.isnot(None))
+            if not rewrite:
+                query = query.where(table.c.excerpt.is_(None))
+            rows = conn.execute(query.order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            conn.execute(update, [{'post_id': row[0], 'new_excerpt': make_excerpt(row[1])} for row in rows])
+        last_id = rows[-1][0]
+        done += len(rows)
+        yield done
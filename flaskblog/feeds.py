@@ -0,0 +1,117 @@
+'''Atom and JSON feeds of the posts, written entry by entry so they can be streamed'''
+import json
+from xml.sax.saxutils import escape, quoteattr
+from flask import url_for
+from flaskblog import app, db, jobs
+from flaskblog.models import User, Post
+from flaskblog.queries import post_feed
+from flaskblog.rendering import render_html
+
+app.config.setdefault('FEED_SIZE', 20)
+SITE_TITLE = 'Designer Blog'
+
+
+def feed_posts(user_id=None):
+    ''' this is a function to query the newest FEED_SIZE posts of a feed, with authors and content.'''
+    return (post_feed(user_id, content=True).order_by(Post.date_posted.desc(), Post.id.desc())
+            .limit(app.config['FEED_SIZE']))
+
+
+def _rfc3339(value):
+    return value.replace(microsecond=0).isoformat() + 'Z'
+
+
+def _html(post):
+    #posts stored before render-on-write have no html yet
+    return post.content_html if post.content_html is not None else render_html(post.content)
+
+
+def _tags(post):
+    return ['post:%d' % post.id, 'user:%d' % post.user_id]
+
+
+def atom_feed(posts, title, feed_url, updated, tags):
+    ''' this is a function to write an Atom feed.
+
+    Args:
+        posts: the posts, newest first. read one at a time
+        title: title of the feed
+        feed_url: absolute url of the feed itself
+        updated: datetime of the last change of the feed
+        tags: list the cache tags of every written post are appended to
+
+    Return:
+        a generator of the xml, one chunk per entry.
+    '''
+    yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+           '  <title>%s</title>\n  <id>%s</id>\n'
+           '  <link rel="self" type="application/atom+xml" href=%s/>\n'
+           '  <link rel="alternate" type="text/html" href=%s/>\n'
+           '  <updated>%s</updated>\n') % (
+        escape(title), escape(feed_url), quoteattr(feed_url), quoteattr(url_for('home', _external=True)),
+        _rfc3339(updated))
+    for post in posts:
+        post_url = url_for('post', post_id=post.id, _external=True)
+        yield ('  <entry>\n    <title>%s</title>\n    <id>%s</id>\n'
+               '    <link rel="alternate" type="text/html" href=%s/>\n'
+               '    <published>%s</published>\n    <updated>%s</updated>\n'
+               '    <author><name>%s</name><uri>%s</uri></author>\n'
+               '    <summary>%s</summary>\n    <content type="html">%s</content>\n  </entry>\n') % (
+            escape(post.title), escape(post_url), quoteattr(post_url), _rfc3339(post.date_posted),
+            _rfc3339(post.updated_at or post.date_posted), escape(post.author.username),
+            escape(url_for('user_posts', username=post.author.username, _external=True)),
+            escape(post.excerpt or ''), escape(_html(post)))
+        tags.extend(_tags(post))
+    yield '</feed>\n'
+
+
+def json_feed(posts, title, feed_url, updated, tags):
+    ''' this is a function to write a JSON Feed 1.1. the arguments are the ones of atom_feed.
+
+    Return:
+        a generator of the json, one chunk per item.
+    '''
+    head = json.dumps({
+        'version': 'https://jsonfeed.org/version/1.1', 'title': title,
+        'home_page_url': url_for('home', _external=True), 'feed_url': feed_url,
+    })
+    yield head[:-1] + ', "items": ['
+    separator = '\n'
+    for post in posts:
+        post_url = url_for('post', post_id=post.id, _external=True)
+        yield separator + json.dumps({
+            'id': post_url, 'url': post_url, 'title': post.title, 'summary': post.excerpt or '',
+            'content_html': _html(post), 'date_published': _rfc3339(post.date_posted),
+            'date_modified': _rfc3339(post.updated_at or post.date_posted),
+            'authors': [{'name': post.author.username,
+                         'url': url_for('user_posts', username=post.author.username, _external=True)}],
+        })
+        separator = ',\n'
+        tags.extend(_tags(post))
+    yield '\n]}\n'
+
+
+#the feeds a post was dropped from are written again by a worker, so the next reader gets them from the cache
+@jobs.handler('warm-feeds')
+def warm_feeds(payload):
+    ''' this is a job to write the site feeds and the feed of one author into the cache.
+
+    Args:
+        payload: {'base_url': request.url_root of the request that changed the posts, 'user_id': the author}
+            the feeds are cached per host, so they are requested on the same one
+
+    '''
+    urls = app.url_map.bind('localhost')
+    paths = [urls.build('feed_atom'), urls.build('feed_json')]
+    author = db.session.get(User, payload['user_id'])
+    if author is not None:
+        paths.append(urls.build('user_feed_atom', {'username': author.username}))
+    client = app.test_client()
+    for path in paths:
+        response = client.get(path, base_url=payload['base_url'])
+        #the streamed feed is stored once its last entry was read
+        response.get_data()
+        response.close()
+        if response.status_code != 200:
+            raise RuntimeError('%s answered %s' % (path, response.status))
@@ -4,7 +4,8 @@ from flask_wtf.file import FileField, FileAllowed
 from flask_login import current_user
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
-from flaskblog.models import User
+from flaskblog.availability import index, normalize
+from flaskblog.avatars import check_upload
 
 #store the username and email from the input information
 #use validators to check the input format
@@ -33,31 +34,27 @@ class RegistrationForm(FlaskForm):
     confirm_password = PasswordField('Confirm Password',
                                      validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField('Sign Up')
-    #check if the username is already taken via query
+    #check if the username is already taken, in the in-memory index. the unique constraint catches the rest at commit
     def validate_username(self, username):
         ''' this is a function to check whether the username is valid.
         Args:
-            usesr: input from the user, query by username
             username: stored username data
 
         Return:
-            check if new inputted username equals to username.data, if so, raise error
+            raise an error if the availability index has the username, see flaskblog/availability.py
         '''
-        user = User.query.filter_by(username=username.data).first()
-        if user:
+        if index.is_taken('username', username.data):
             raise ValidationError('That username is taken. Please choose a different one.')
-    #check if the username is already taken via query
+    #check if the email is already taken, in the in-memory index
     def validate_email(self, email):
         ''' this is a function to check whether the email is valid.
         Args:
-            usesr: input from the user, query by email
             email: stored email data
 
         Return:
-            check if new inputted email equals to username.data, if so, raise error
+            raise an error if the availability index has the email
         '''
-        user = User.query.filter_by(email=email.data).first()
-        if user:
+        if index.is_taken('email', email.data):
             raise ValidationError('That email is taken. Please choose a different one.')
 
 
@@ -118,18 +115,24 @@ class UpdateAccountForm(FlaskForm):
     def validate_username(self, username):
         '''function to check if the username is already taken. explained previously. '''
         #if not match, store the input as the new username
-        if username.data != current_user.username:
-            user = User.query.filter_by(username=username.data).first()
+        if normalize(username.data) != normalize(current_user.username):
             #if match, give an error message.
-            if user:
+            if index.is_taken('username', username.data):
                 raise ValidationError('That username is taken. Please choose a different one.')
     #
     def validate_email(self, email):
         '''function to check if the email is already taken. explained previously.'''
-        if email.data != current_user.email:
-            user = User.query.filter_by(email=email.data).first()
-            if user:
+        if normalize(email.data) != normalize(current_user.email):
+            if index.is_taken('email', email.data):
                 raise ValidationError('That email is taken. Please choose a different one.')
+    #check the size of the picture before it is queued for processing
+    def validate_picture(self, picture):
+        '''function to reject oversized pictures and decompression bombs. keep the bytes for the route in picture.bytes.'''
+        if picture.data:
+            try:
+                picture.bytes = check_upload(picture.data)
+            except ValueError as e:
+                raise ValidationError(str(e))
 
 
 #post form, including title input, content input, and submit button.
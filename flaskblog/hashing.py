@@ -0,0 +1,107 @@
+'''bcrypt hashing on a bounded executor, so a login storm can not take every request thread'''
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flaskblog import app, bcrypt, metrics
+
+app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+app.config.setdefault('HASH_WORKERS', 2)
+app.config.setdefault('HASH_QUEUE_SIZE', 8)
+app.config.setdefault('HASH_QUEUE_TIMEOUT', 0.05)
+
+#bcrypt releases the GIL, so the threads hash in parallel while the request threads keep serving pages
+_executor = ThreadPoolExecutor(max_workers=app.config['HASH_WORKERS'], thread_name_prefix='bcrypt')
+_slots = threading.BoundedSemaphore(app.config['HASH_WORKERS'] + app.config['HASH_QUEUE_SIZE'])
+
+
+class HashingBusy(Exception):
+    '''this is raised when every hashing slot is taken. the request is answered with 503.'''
+
+
+class HashStats(object):
+    '''this is a class to count the work of the hashing executor.
+
+    Attributes:
+        hashed: number of passwords hashed
+        checked: number of passwords verified
+        rejected: number of requests turned away because the executor was full
+        seconds: total time spent hashing and verifying
+        waiting: number of jobs submitted and not finished, the queue depth
+
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hashed = self.checked = self.rejected = self.waiting = 0
+        self.seconds = 0.0
+
+    def add(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {'hashed': self.hashed, 'checked': self.checked, 'rejected': self.rejected,
+                    'seconds': self.seconds, 'waiting': self.waiting}
+
+
+stats = HashStats()
+metrics.Collector('flaskblog_bcrypt_rejected_total', 'Hashing requests turned away with 503.', 'counter',
+                  lambda: [((), stats.snapshot()['rejected'])])
+metrics.Collector('flaskblog_bcrypt_waiting', 'Hashing jobs submitted and not finished.', 'gauge',
+                  lambda: [((), stats.snapshot()['waiting'])])
+
+
+def _timed(counter, fn, *args):
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        elapsed = time.perf_counter() - start
+        stats.add('seconds', elapsed)
+        stats.add(counter)
+        metrics.bcrypt_seconds.observe(elapsed, counter)
+
+
+#run fn on the executor and wait for it. give up at once if too many are already waiting.
+def _run(counter, fn, *args):
+    if not _slots.acquire(timeout=app.config['HASH_QUEUE_TIMEOUT']):
+        stats.add('rejected')
+        raise HashingBusy()
+    stats.add('waiting')
+    try:
+        return _executor.submit(_timed, counter, fn, *args).result()
+    finally:
+        stats.add('waiting', -1)
+        _slots.release()
+
+
+def generate_password_hash(password):
+    ''' this is a function to hash a password with the current BCRYPT_LOG_ROUNDS.
+
+    Return:
+        the hash as a string. raise HashingBusy if the executor is full.
+    '''
+    rounds = app.config['BCRYPT_LOG_ROUNDS']
+    return _run('hashed', bcrypt.generate_password_hash, password, rounds).decode('utf-8')
+
+
+def check_password_hash(pw_hash, password):
+    ''' this is a function to verify a password. raise HashingBusy if the executor is full.'''
+    return _run('checked', bcrypt.check_password_hash, pw_hash, password)
+
+
+#a hash looks like $2b$12$..., the number is the log2 of the rounds it was made with
+def needs_rehash(pw_hash):
+    ''' this is a function to check if a hash was made with fewer rounds than BCRYPT_LOG_ROUNDS.'''
+    try:
+        cost = int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return cost < app.config['BCRYPT_LOG_ROUNDS']
+
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    ''' this is a function to answer 503 when the hashing executor is saturated.'''
+    return 'The server is busy. Please try again in a moment.', 503, {'Retry-After': '1'}
@@ -0,0 +1,257 @@
+'''durable background jobs: a queue table in the database, run by "flask worker" or by threads of the app itself'''
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import delete, event, func, select, text, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+from flaskblog import app, db, metrics
+from flaskblog.database import RoutingSession
+from flaskblog.models import Job
+
+logger = logging.getLogger(__name__)
+
+app.config.setdefault('JOBS_WORKERS', 2)
+#seconds an idle worker sleeps before it looks for due jobs again. in-app workers are also woken by every commit that queued a job
+app.config.setdefault('JOBS_POLL_INTERVAL', 1.0)
+app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+#seconds before the first retry, doubled for every further one, at most JOBS_BACKOFF_MAX
+app.config.setdefault('JOBS_BACKOFF', 10)
+app.config.setdefault('JOBS_BACKOFF_MAX', 3600)
+#a job running longer than this many seconds is taken to belong to a dead worker and is started again
+app.config.setdefault('JOBS_TIMEOUT', 600)
+#run the jobs on threads of the web process. turn it off when "flask worker" runs them
+app.config.setdefault('JOBS_IN_APP', True)
+
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+
+job_wait_seconds = metrics.Histogram('flaskblog_job_wait_seconds', 'Time a job was due before a worker started it.',
+                                     ('kind',), WAIT_BUCKETS)
+job_seconds = metrics.Histogram('flaskblog_job_seconds', 'Run time of one attempt of a job.', ('kind', 'outcome'),
+                                WAIT_BUCKETS)
+
+#kind -> function(payload), see handler
+handlers = {}
+
+
+def handler(kind):
+    ''' this is a decorator to register the function that runs the jobs of a kind.
+
+    Args:
+        kind: the name given to enqueue
+
+    Return:
+        the decorator. the function is called with the payload, inside an app context. raising makes the job retry.
+    '''
+    def register(function):
+        handlers[kind] = function
+        return function
+    return register
+
+
+#the insert is part of the current transaction, so the job is queued only if the change that needs it is committed
+def enqueue(kind, payload, delay=0, dedupe=True):
+    ''' this is a function to queue a job. commit the session to hand it to the workers.
+
+    Args:
+        kind: the kind of the job, registered with handler
+        payload: json serializable arguments of the job
+        delay: seconds before the job may start
+        dedupe: if True, nothing is queued while an identical job is still waiting
+
+    Return:
+        True if the job was queued, False if its twin was waiting already.
+    '''
+    body = json.dumps(payload, sort_keys=True)
+    key = hashlib.sha1((kind + '\n' + body).encode('utf-8')).hexdigest() if dedupe else None
+    now = datetime.utcnow()
+    statement = insert(Job.__table__).values(
+        kind=kind, payload=body, dedupe_key=key, state='queued', attempts=0,
+        run_at=now + timedelta(seconds=delay), created_at=now,
+    ).on_conflict_do_nothing(index_elements=['dedupe_key'], index_where=text("state = 'queued'"))
+    queued = db.session.execute(statement).rowcount == 1
+    db.session.info['jobs_queued'] = True
+    return queued
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _wake_after_commit(session):
+    if session.info.pop('jobs_queued', False):
+        _wake.set()
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_after_rollback(session):
+    session.info.pop('jobs_queued', None)
+
+
+#one UPDATE takes the job, so two workers never start the same one, whichever process they are in
+def claim(worker):
+    ''' this is a function to start the next due job.
+
+    Args:
+        worker: name of the worker, stored on the job
+
+    Return:
+        the row (id, kind, payload, attempts, run_at) of the job, or None if no job is due.
+    '''
+    job = Job.__table__
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=app.config['JOBS_TIMEOUT'])
+    due = select(job.c.id).where(
+        ((job.c.state == 'queued') & (job.c.run_at <= now)) |
+        ((job.c.state == 'running') & (job.c.started_at < stale))
+    ).order_by(job.c.run_at, job.c.id).limit(1).scalar_subquery()
+    with db.engine.begin() as conn:
+        return conn.execute(update(job).where(job.c.id == due).values(
+            state='running', attempts=job.c.attempts + 1, started_at=now, worker=worker,
+        ).returning(job.c.id, job.c.kind, job.c.payload, job.c.attempts, job.c.run_at)).first()
+
+
+def _backoff(attempts):
+    delay = min(app.config['JOBS_BACKOFF'] * 2 ** (attempts - 1), app.config['JOBS_BACKOFF_MAX'])
+    #spread the retries of jobs that failed together, e.g. while the database was locked
+    return delay * random.uniform(0.8, 1.2)
+
+
+def run(row):
+    ''' this is a function to run a claimed job and record the outcome.
+
+    Return:
+        'done', 'retry' or 'failed'. done jobs are deleted, failed ones are kept for "flask blog jobs".
+    '''
+    job = Job.__table__
+    job_wait_seconds.observe(max(0.0, (datetime.utcnow() - row.run_at).total_seconds()), row.kind)
+    start = time.perf_counter()
+    #the attempts stay in the where clauses: a job started again after JOBS_TIMEOUT belongs to the new attempt
+    mine = (job.c.id == row.id) & (job.c.attempts == row.attempts)
+    try:
+        function = handlers[row.kind]
+        with app.app_context():
+            function(json.loads(row.payload))
+    except Exception:
+        error = traceback.format_exc()
+        if row.attempts >= app.config['JOBS_MAX_ATTEMPTS']:
+            outcome, values = 'failed', {'state': 'failed', 'last_error': error}
+            logger.error('job %d (%s) failed for good after %d attempts\n%s', row.id, row.kind, row.attempts, error)
+        else:
+            run_at = datetime.utcnow() + timedelta(seconds=_backoff(row.attempts))
+            outcome, values = 'retry', {'state': 'queued', 'run_at': run_at, 'last_error': error}
+            logger.warning('job %d (%s) failed, retry at %s\n%s', row.id, row.kind, run_at, error)
+        with db.engine.begin() as conn:
+            #OR IGNORE: an identical job was queued meanwhile. it does the same work, so this one goes
+            if not conn.execute(update(job).prefix_with('OR IGNORE').where(mine).values(**values)).rowcount:
+                conn.execute(delete(job).where(mine))
+    else:
+        outcome = 'done'
+        with db.engine.begin() as conn:
+            conn.execute(delete(job).where(mine))
+    job_seconds.observe(time.perf_counter() - start, row.kind, outcome)
+    return outcome
+
+
+def work(name, stop, wake=None, burst=False):
+    ''' this is a function to run jobs until stop is set.
+
+    Args:
+        name: name of the worker
+        stop: threading.Event, the worker returns after its current job when it is set
+        wake: threading.Event that cuts the sleep between two polls short
+        burst: return as soon as no job is due
+
+    '''
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                row = claim(name)
+            except SQLAlchemyError:
+                #e.g. the database is locked for longer than busy_timeout, or the job table is missing
+                logger.exception('worker %s could not claim a job', name)
+                row = None
+            if row is not None:
+                try:
+                    run(row)
+                except SQLAlchemyError:
+                    #the outcome could not be written. the job is started again once JOBS_TIMEOUT is over
+                    logger.exception('worker %s could not finish job %d', name, row.id)
+                    stop.wait(app.config['JOBS_POLL_INTERVAL'])
+                continue
+            if burst:
+                return
+            (wake or stop).wait(app.config['JOBS_POLL_INTERVAL'])
+            if wake is not None:
+                wake.clear()
+
+
+def start(count, stop, wake=None, burst=False, prefix='worker'):
+    ''' this is a function to start count worker threads. return the threads.'''
+    threads = []
+    for number in range(count):
+        name = '%s-%d-%d' % (prefix, os.getpid(), number + 1)
+        thread = threading.Thread(target=work, args=(name, stop, wake, burst), name=name, daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def pending():
+    ''' this is a function to count the jobs that are due or running.'''
+    return db.session.query(func.count(Job.id)).filter(
+        ((Job.state == 'queued') & (Job.run_at <= datetime.utcnow())) | (Job.state == 'running')).scalar()
+
+
+def wait_idle(timeout=60):
+    ''' this is a function to wait until every due job is done, e.g. before a benchmark cleans up. return True if it is.'''
+    deadline = time.time() + timeout
+    while pending():
+        if time.time() > deadline:
+            return False
+        db.session.rollback()
+        time.sleep(0.05)
+    return True
+
+
+_wake = threading.Event()
+_in_app = []
+_in_app_lock = threading.Lock()
+
+
+#start the in-app workers with the first request, they also pick up the jobs left by the last run
+@app.before_request
+def _start_in_app():
+    if _in_app or not app.config['JOBS_IN_APP']:
+        return
+    with _in_app_lock:
+        if not _in_app:
+            _in_app.extend(start(app.config['JOBS_WORKERS'], threading.Event(), _wake, prefix='app-job'))
+
+
+def _depth():
+    try:
+        rows = db.session.execute(select(Job.kind, Job.state, func.count(Job.id)).group_by(Job.kind, Job.state))
+        return [((kind, state), count) for kind, state, count in rows]
+    except SQLAlchemyError:
+        db.session.rollback()
+        return []
+
+
+def _oldest():
+    now = datetime.utcnow()
+    try:
+        rows = db.session.execute(select(Job.kind, func.min(Job.run_at)).where(
+            Job.state == 'queued', Job.run_at <= now).group_by(Job.kind))
+        return [((kind, ), (now - run_at).total_seconds()) for kind, run_at in rows]
+    except SQLAlchemyError:
+        db.session.rollback()
+        return []
+
+
+metrics.Collector('flaskblog_jobs', 'Jobs in the queue table.', 'gauge', _depth, ('kind', 'state'))
+metrics.Collector('flaskblog_job_oldest_due_seconds', 'Age of the oldest due job no worker has started yet.', 'gauge',
+                  _oldest, ('kind',))
@@ -0,0 +1,198 @@
+'''per-request timing, SQL and template metrics, served on /metrics in the Prometheus text format'''
+import logging
+import threading
+import time
+from flask import Response, g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from flaskblog import app
+
+logger = logging.getLogger(__name__)
+
+app.config.setdefault('METRICS_ENABLED', True)
+#requests slower than this many seconds are logged with their SQL. None turns the log off
+app.config.setdefault('SLOW_REQUEST_THRESHOLD', None)
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Histogram(object):
+    '''this is a histogram with fixed buckets, one series per combination of label values.
+
+    Args:
+        name: metric name
+        help: one line description
+        labels: label names, the values are given to observe in the same order
+        buckets: upper bounds of the buckets, +Inf is added
+
+    '''
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            items = sorted(self._series.items())
+            for label_values, (counts, total, count) in items:
+                names = self.labels + ('le',)
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %d' % (self.name, _labels(names, label_values + (repr(float(bound)),)), bucket))
+                lines.append('%s_bucket%s %d' % (self.name, _labels(names, label_values + ('+Inf',)), count))
+                lines.append('%s_sum%s %r' % (self.name, _labels(self.labels, label_values), total))
+                lines.append('%s_count%s %d' % (self.name, _labels(self.labels, label_values), count))
+        return lines
+
+
+class Collector(object):
+    '''this is a set of counters or gauges read from a function when /metrics is scraped.
+
+    Args:
+        name: metric name
+        help: one line description
+        kind: 'counter' or 'gauge'
+        collect: function returning a list of (label values tuple, value)
+        labels: label names
+
+    '''
+
+    def __init__(self, name, help, kind, collect, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.collect = collect
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for label_values, value in self.collect():
+            lines.append('%s%s %r' % (self.name, _labels(self.labels, label_values), value))
+        return lines
+
+
+registry = []
+
+request_seconds = Histogram('flaskblog_request_seconds', 'Wall time of a request.',
+                            ('endpoint', 'method', 'status'))
+request_sql_statements = Histogram('flaskblog_request_sql_statements', 'SQL statements run by a request.',
+                                   ('endpoint',), COUNT_BUCKETS)
+request_sql_seconds = Histogram('flaskblog_request_sql_seconds', 'Time a request spent in SQL statements.',
+                                ('endpoint',))
+template_seconds = Histogram('flaskblog_template_render_seconds', 'Time to render a Jinja template.',
+                             ('template',))
+image_seconds = Histogram('flaskblog_image_processing_seconds', 'Time to decode and write the renditions of an avatar.')
+bcrypt_seconds = Histogram('flaskblog_bcrypt_seconds', 'Time of one bcrypt hash or check.', ('operation',),
+                           (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+
+
+#SQL timing on every engine. the statements of a request are also kept for the slow request log
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_start')
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context() and 'metrics_sql' in g:
+        g.metrics_sql.append((elapsed, statement))
+
+
+@before_render_template.connect_via(app)
+def _before_render(sender, template, context, **extra):
+    if has_request_context():
+        g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def _template_rendered(sender, template, context, **extra):
+    if has_request_context() and g.get('metrics_templates'):
+        template_seconds.observe(time.perf_counter() - g.metrics_templates.pop(), template.name or 'string')
+
+
+@app.before_request
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_sql = []
+
+
+@app.after_request
+def _finish_request(response):
+    if 'metrics_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.metrics_start
+    endpoint = request.endpoint or 'unmatched'
+    sql = g.metrics_sql
+    sql_seconds = sum(seconds for seconds, _ in sql)
+    request_seconds.observe(elapsed, endpoint, request.method, response.status_code)
+    request_sql_statements.observe(len(sql), endpoint)
+    request_sql_seconds.observe(sql_seconds, endpoint)
+    threshold = app.config['SLOW_REQUEST_THRESHOLD']
+    if threshold is not None and elapsed >= threshold:
+        lines = ['slow request %s %s: %.1fms, %d SQL statements in %.1fms' % (
+            request.method, request.full_path.rstrip('?'), elapsed * 1000, len(sql), sql_seconds * 1000)]
+        lines.extend('  %.1fms %s' % (seconds * 1000, ' '.join(statement.split())) for seconds, statement in sql)
+        logger.warning('\n'.join(lines))
+    return response
+
+
+MIMETYPE = 'text/plain; version=0.0.4'
+
+
+def exposition():
+    ''' this is a function to write every metric in the Prometheus text format. it needs an app context.'''
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+@app.route("/metrics")
+def metrics():
+    ''' this is a function to expose every metric in the Prometheus text format.
+
+    Return:
+        404 if METRICS_ENABLED is off, else the metrics as text/plain.
+    '''
+    if not app.config['METRICS_ENABLED']:
+        return 'Not Found', 404
+    return Response(exposition(), mimetype=MIMETYPE)
+
+
+#a wsgi app with nothing but the metrics, for processes that serve no pages, e.g. flask worker --metrics-port
+def metrics_app(environ, start_response):
+    with app.app_context():
+        response = Response(exposition(), mimetype=MIMETYPE)
+    return response(environ, start_response)
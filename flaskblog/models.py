@@ -1,13 +1,39 @@
 '''import packages'''
+from collections import namedtuple
 from datetime import datetime
-from flaskblog import db, login_manager
+from flaskblog import db, login_manager, identity_cache
 from flask_login import UserMixin
 
 
+#read-only copy of the user row that current_user points to. it is cached, so it never touches the database
+class UserSnapshot(UserMixin, namedtuple('UserSnapshot', 'id username email image_file')):
+    '''this is a lightweight, immutable stand-in for User as current_user.
+
+    Attributes:
+        id, username, email, image_file: copied from the User row when it was loaded
+    
+    To change the user, load the User row by current_user.id and call forget_user after the commit.
+    '''
+    __slots__ = ()
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    '''this is a functin to load the user data package by user_id'''
-    return User.query.get(int(user_id))
+    '''this is a functin to load the user data package by user_id. served from the identity cache when possible.'''
+    key = 'user:%s' % user_id
+    snapshot = identity_cache.get(key)
+    if snapshot is None:
+        user = User.query.get(int(user_id))
+        if user is None:
+            return None
+        snapshot = UserSnapshot(user.id, user.username, user.email, user.image_file)
+        identity_cache.set(key, snapshot)
+    return snapshot
+
+
+def forget_user(user_id):
+    '''this is a function to drop a user from the identity cache after username / email / image_file changed.'''
+    identity_cache.delete('user:%s' % user_id)
 
 #userdata class. including 
 class User(db.Model, UserMixin):
@@ -16,16 +42,22 @@ class User(db.Model, UserMixin):
     Attributes:
         username: user name got from the input
         email: user email got from the input
-        image_file: user image got from the input. if not uploaded, use the default.jpg
+        image_file: user image got from the input. if not uploaded, use the default.jpg.
+            uploaded pictures are named by content, e.g. 3f/a2/3fa2....jpg under static/profile_pics
         password: user password got from the input
         posts: user post, query from the author variable by username
+        post_count, last_post_at, content_bytes: number of posts, date of the newest one and size of
+            their contents in bytes. kept up to date by flaskblog/stats.py, never set them by hand
 
     '''
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    image_file = db.Column(db.String(20), nullable=False, default='default.jpg')
+    image_file = db.Column(db.String(64), nullable=False, default='default.jpg')
     password = db.Column(db.String(60), nullable=False)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_post_at = db.Column(db.DateTime)
+    content_bytes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     posts = db.relationship('Post', backref='author', lazy=True)
 
     def __repr__(self):
@@ -39,16 +71,74 @@ class Post(db.Model):
     Attributes:
         title: post title from the input
         date_posted: generated from datetime.utcnow
-        content: post content from the input
+        updated_at: set when the post is created and on every update_post. Last-Modified of the pages
+        content: post content from the input. the list pages do not load it
+        content_html: the content rendered from markdown to sanitized html when it was written
+        renderer_version: RENDERER_VERSION of the renderer that wrote content_html, see flaskblog/rendering.py
+        excerpt: the start of the content as plain text, for the list pages. see flaskblog/excerpts.py
         user_id: current user.id
+
+    Indexes:
+        (date_posted, id) for the home feed, (user_id, date_posted, id) for the user feed.
+        both feeds are read newest first by keyset, see flaskblog/pagination.py
+        updated_at and (user_id, updated_at) find the last change of a feed, see flaskblog/conditional.py
     
     '''
+    __table_args__ = (
+        db.Index('ix_post_date_posted', 'date_posted', 'id'),
+        db.Index('ix_post_user_id_date_posted', 'user_id', 'date_posted', 'id'),
+        db.Index('ix_post_updated_at', 'updated_at'),
+        db.Index('ix_post_user_id_updated_at', 'user_id', 'updated_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
     content = db.Column(db.Text, nullable=False)
+    content_html = db.Column(db.Text)
+    renderer_version = db.Column(db.String(16))
+    excerpt = db.Column(db.String(300))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     def __repr__(self):
-        return f"Post('{self.title}', '{self.date_posted}')"
\ No newline at end of file
+        return f"Post('{self.title}', '{self.date_posted}')"
+
+#background job, run by "flask worker". see flaskblog/jobs.py
+class Job(db.Model):
+    '''this is the job queue data class
+
+    Attributes:
+        kind: name of the handler, e.g. 'avatar'
+        payload: json arguments of the handler
+        dedupe_key: hash of kind and payload. an identical job is not queued twice
+        state: 'queued', 'running' or 'failed'. done jobs are deleted
+        attempts: number of times a worker started the job
+        run_at: the job is not started before this time. pushed back after a failure
+        created_at, started_at: when it was queued and when the last attempt started
+        worker: name of the worker thread of the last attempt
+        last_error: traceback of the last failure
+
+    Indexes:
+        (state, run_at) to claim the next job. the unique dedupe_key only counts queued jobs, so a
+        job queued while its twin is running still runs after it
+    '''
+    __table_args__ = (
+        db.Index('ix_job_state_run_at', 'state', 'run_at'),
+        db.Index('ix_job_dedupe_key', 'dedupe_key', unique=True, sqlite_where=db.text("state = 'queued'")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    dedupe_key = db.Column(db.String(40))
+    state = db.Column(db.String(10), nullable=False, default='queued', server_default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    worker = db.Column(db.String(50))
+    last_error = db.Column(db.Text)
+
+    def __repr__(self):
+        return f"Job('{self.kind}', '{self.state}', {self.attempts})"
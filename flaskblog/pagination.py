@@ -0,0 +1,203 @@
+'''keyset (cursor) pagination for the post feeds'''
+import base64
+import binascii
+import json
+from datetime import datetime
+from math import ceil
+from flask import abort
+from sqlalchemy import tuple_
+from flaskblog.models import Post
+
+
+#encode the (date_posted, id) key of a post and the page it leads to into an opaque token
+def encode_cursor(post, page, direction):
+    ''' this is a function to build the opaque cursor token for a page boundary.
+
+    Args:
+        post: the boundary post. its (date_posted, id) is the keyset key. None for 'last'
+        page: the page number the token leads to, so the navigation can highlight it
+        direction: 'next' for older posts, 'prev' for newer posts, 'last' for the oldest ones
+
+    Return:
+        an url safe string without padding
+    '''
+    key = [post.date_posted.isoformat(), post.id] if post is not None else [None, None]
+    raw = json.dumps(key + [page, direction], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+#decode a cursor token. a broken or tampered token is a bad request
+def decode_cursor(token):
+    ''' this is a function to read back a token made by encode_cursor.
+
+    Return:
+        date_posted, id, page, direction. date_posted and id are None for 'last'.
+        abort with 400 if the token is not valid.
+    '''
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        date_posted, post_id, page, direction = json.loads(raw.decode('utf-8'))
+        if direction not in ('next', 'prev', 'last') or int(page) < 1:
+            raise ValueError(direction)
+        if direction == 'last':
+            return None, None, int(page), direction
+        return datetime.fromisoformat(date_posted), int(post_id), int(page), direction
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        abort(400)
+
+
+class KeysetPagination(object):
+    '''this is a page of posts loaded by keyset. it has the same interface as the flask_sqlalchemy pagination the templates use.
+
+    Attributes:
+        items: the posts of this page, newest first
+        page: current page number
+        per_page: max posts per page
+        total: approximate number of posts, or None if no count was asked for
+        pages: approximate number of pages
+        has_next, has_prev: if there is an older / newer page
+        cursors: page number -> token to load that page by keyset, for the pages around this one
+            and for this one, if it was loaded by a cursor
+        next_cursor, prev_cursor: tokens to load the older / newer page by keyset
+
+    '''
+
+    def __init__(self, items, page, per_page, total, cursors):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.cursors = cursors
+        self.has_next = page + 1 in cursors
+        self.has_prev = page - 1 in cursors
+        self.next_num = page + 1 if self.has_next else None
+        self.prev_num = page - 1 if self.has_prev else None
+        self.next_cursor = cursors.get(page + 1)
+        self.prev_cursor = cursors.get(page - 1)
+        #the count is only an estimate, never show fewer pages than the ones we know exist
+        known = max([page] + list(cursors))
+        self.pages = max(int(ceil(total / float(per_page))), known) if total else known
+
+    def link_args(self, page_num):
+        ''' this is a function to get the url arguments of a page link.
+
+        Return:
+            the cursor of the pages around this one, so they cost the same on any page. the last page
+            is read from the oldest post up. the page number for the other pages, and for the first one.
+        '''
+        if page_num in self.cursors:
+            return {'cursor': self.cursors[page_num]}
+        if page_num == self.pages and page_num > self.page:
+            return {'cursor': encode_cursor(None, page_num, 'last')}
+        return {'page': page_num}
+
+    def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
+        ''' this is a function to list the page numbers for the navigation. None is a gap.'''
+        last = 0
+        for num in range(1, self.pages + 1):
+            if (num <= left_edge
+                    or self.page - left_current - 1 < num < self.page + right_current
+                    or num > self.pages - right_edge):
+                if last + 1 != num:
+                    yield None
+                yield num
+                last = num
+
+
+NEWEST_FIRST = (Post.date_posted.desc(), Post.id.desc())
+OLDEST_FIRST = (Post.date_posted.asc(), Post.id.asc())
+
+
+def _offset_page(query, page, per_page, limit):
+    return query.order_by(*NEWEST_FIRST).offset((page - 1) * per_page).limit(limit).all()
+
+
+#the keys of the posts past one end of a page, enough to find the first posts of the pages after it
+def _keys(query, boundary, older, limit):
+    key = tuple_(Post.date_posted, Post.id)
+    if older:
+        query = query.filter(key < (boundary.date_posted, boundary.id)).order_by(*NEWEST_FIRST)
+    else:
+        query = query.filter(key > (boundary.date_posted, boundary.id)).order_by(*OLDEST_FIRST)
+    return query.with_entities(Post.date_posted, Post.id).limit(limit).all()
+
+
+def _cursors(items, page, per_page, window, older, newer):
+    #older: the posts after the page, newest first. newer: the posts before it, oldest first.
+    #the page k pages away starts after the last post of the page k - 1 pages away
+    cursors = {}
+    for k in range(1, window + 1):
+        if len(older) > (k - 1) * per_page:
+            cursors[page + k] = encode_cursor(older[(k - 1) * per_page - 1] if k > 1 else items[-1], page + k, 'next')
+        if len(newer) > (k - 1) * per_page and page - k >= 1:
+            cursors[page - k] = encode_cursor(newer[(k - 1) * per_page - 1] if k > 1 else items[0], page - k, 'prev')
+    return cursors
+
+
+#load one page of a post query by keyset. order is (date_posted, id) newest first
+def paginate_keyset(query, cursor=None, page=1, per_page=5, count=None, window=2):
+    ''' this is a function to paginate the posts without a COUNT(*) and without OFFSET scans.
+
+    Args:
+        query: the post query, filtered but not ordered
+        cursor: token from a page link. it wins over page
+        page: page number. only used to jump to a page without a cursor
+        per_page: max posts per page
+        count: optional function returning the approximate number of posts
+        window: the links of this many pages before and after the page get a cursor
+
+    Return:
+        KeysetPagination. a page number past the end gives the last page. abort with 404 if a cursor
+        leads to an empty page.
+    '''
+    key = tuple_(Post.date_posted, Post.id)
+    #the page and the posts of the pages after it that are read anyway, window pages of them
+    ahead = per_page * window + 1
+    older = newer = None
+    if cursor:
+        date_posted, post_id, page, direction = decode_cursor(cursor)
+        if direction == 'next':
+            rows = query.filter(key < (date_posted, post_id)).order_by(*NEWEST_FIRST).limit(ahead).all()
+            older = rows[per_page:]
+            rows = rows[:per_page]
+        else:
+            #newer posts, or the oldest ones for the last page, are read upwards and flipped back
+            if direction == 'prev':
+                query_up = query.filter(key > (date_posted, post_id))
+            else:
+                query_up, older = query, []
+            rows = query_up.order_by(*OLDEST_FIRST).limit(ahead).all()
+            newer = rows[per_page:]
+            rows = rows[:per_page][::-1]
+            if not newer:
+                page = 1
+    else:
+        page = max(page, 1)
+        #a page number without cursor falls back to OFFSET. the links between pages carry cursors
+        rows = _offset_page(query, page, per_page, ahead)
+        if not rows and page > 1:
+            #the count is an estimate, e.g. max(id) after posts were deleted, so the navigation may link
+            #pages past the end. show the real last page instead, and count exactly for its navigation
+            total = query.order_by(None).count()
+            page = max(int(ceil(total / float(per_page))), 1)
+            rows = _offset_page(query, page, per_page, ahead)
+            count = lambda: total
+        older = rows[per_page:]
+        rows = rows[:per_page]
+        if page == 1:
+            newer = []
+    if not rows:
+        if page != 1:
+            abort(404)
+        cursors = {}
+    else:
+        limit = per_page * (window - 1) + 1
+        if older is None:
+            older = _keys(query, rows[-1], True, limit)
+        if newer is None:
+            newer = _keys(query, rows[0], False, limit)
+        cursors = _cursors(rows, page, per_page, window, older, newer)
+        if cursor:
+            cursors[page] = cursor
+    total = count() if count is not None else None
+    return KeysetPagination(rows, page, per_page, total, cursors)
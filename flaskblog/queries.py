@@ -0,0 +1,24 @@
+'''queries that load posts together with their authors for the list pages'''
+from sqlalchemy.orm import defer, joinedload
+from flaskblog.models import Post
+
+
+#posts of the home feed or of one author, with the author joined in the same SELECT
+def post_feed(user_id=None, content=False):
+    ''' this is a function to build the post query of a feed.
+
+    Args:
+        user_id: only list the posts of this user. None lists all posts.
+        content: load post.content and post.content_html. the list pages show post.excerpt and leave the full text in the database.
+
+    Return:
+        the unordered post query. post.author is loaded by a join, so the templates
+        can read post.author.username and post.author.image_file without one SELECT per post.
+        order and limit it with flaskblog.pagination.paginate_keyset.
+    '''
+    query = Post.query.options(joinedload(Post.author))
+    if not content:
+        query = query.options(defer(Post.content), defer(Post.content_html))
+    if user_id is not None:
+        query = query.filter(Post.user_id == user_id)
+    return query
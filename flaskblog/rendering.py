@@ -0,0 +1,93 @@
+'''markdown posts, rendered to sanitized html once when they are written'''
+from concurrent.futures import ProcessPoolExecutor
+import markdown
+import nh3
+from sqlalchemy import event, or_
+from flaskblog import db
+from flaskblog.excerpts import make_excerpt
+from flaskblog.models import Post
+
+#bump the number when the output of render_html changes, e.g. with a new pinned markdown or nh3 (see Readme.md),
+#then run flask blog rerender-posts
+RENDERER_VERSION = 'markdown-2'
+
+ALLOWED_TAGS = frozenset([
+    'a', 'abbr', 'b', 'blockquote', 'br', 'code', 'del', 'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr',
+    'i', 'img', 'li', 'ol', 'p', 'pre', 'strong', 'table', 'tbody', 'td', 'th', 'thead', 'tr', 'ul',
+])
+ALLOWED_ATTRIBUTES = {'a': {'href', 'title'}, 'abbr': {'title'}, 'img': {'src', 'alt', 'title'}}
+ALLOWED_PROTOCOLS = frozenset(['http', 'https', 'mailto'])
+
+
+def render_html(content):
+    ''' this is a function to turn the text of a post into html.
+
+    Args:
+        content: markdown source of the post
+
+    Return:
+        html that is safe to put into a page as it is. tags, attributes and link
+        protocols outside the ALLOWED_ lists are removed, links get rel="noopener noreferrer".
+    '''
+    html = markdown.markdown(content or '', extensions=['fenced_code', 'tables', 'sane_lists'])
+    return nh3.clean(html, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES, url_schemes=ALLOWED_PROTOCOLS)
+
+
+#new_post and update_post render here, so the post page only reads the stored html. setting it makes the excerpt too
+@event.listens_for(Post.content, 'set')
+def _render_content(post, value, oldvalue, initiator):
+    post.content_html = render_html(value)
+    post.renderer_version = RENDERER_VERSION
+
+
+def _render_batch(rows):
+    params = []
+    for post_id, content in rows:
+        html = render_html(content)
+        params.append({'post_id': post_id, 'html': html, 'new_excerpt': make_excerpt(html)})
+    return params
+
+
+#render again the posts stored by an older renderer, batch_size posts per transaction
+def rerender_posts(batch_size=500, workers=1, rewrite=False):
+    ''' this is a function to bring content_html, and the excerpt cut from it, up to RENDERER_VERSION.
+
+    Args:
+        batch_size: posts read and updated per transaction
+        workers: processes that render in parallel. 1 renders in this process
+        rewrite: render every post, not only the outdated ones
+
+    Return:
+        a generator of the number of posts rendered so far, one value per batch.
+    '''
+    table = Post.__table__
+    update = table.update().where(table.c.id == db.bindparam('post_id')).values(
+        content_html=db.bindparam('html'), excerpt=db.bindparam('new_excerpt'), renderer_version=RENDERER_VERSION)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    last_id, done = 0, 0
+    try:
+        while True:
+            query = db.select(table.c.id, table.c.content).where(table.c.id > last_id)
+            if not rewrite:
+                query = query.where(or_(table.c.renderer_version.is_(None),
+                                        table.c.renderer_version != RENDERER_VERSION))
+            with db.engine.connect() as conn:
+                rows = [tuple(row) for row in conn.execute(query.order_by(table.c.id).limit(batch_size))]
+            if not rows:
+                break
+            if pool is None:
+                params = _render_batch(rows)
+            else:
+                #one chunk per worker, the rendering is the slow part, the database writes are not
+                size = -(-len(rows) // workers)
+                params = []
+                for chunk in pool.map(_render_batch, [rows[i:i + size] for i in range(0, len(rows), size)]):
+                    params.extend(chunk)
+            with db.engine.begin() as conn:
+                conn.execute(update, params)
+            last_id = rows[-1][0]
+            done += len(rows)
+            yield done
+    finally:
+        if pool is not None:
+            pool.shutdown()
@@ -1,32 +1,70 @@
 '''import the pre-setup packages'''
-import os
-import secrets
-from PIL import Image
-from flask import render_template, url_for, flash, redirect, request, abort
-from flaskblog import app, db, bcrypt
+from datetime import datetime
+from flask import render_template, url_for, flash, redirect, request, abort, Response, stream_with_context
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, OperationalError
+from flaskblog import app, db, cache, avatars, hashing, availability, jobs
 from flaskblog.forms import RegistrationForm, LoginForm, UpdateAccountForm, PostForm
-from flaskblog.models import User, Post
+from flaskblog.models import User, Post, forget_user
+from flaskblog.conditional import conditional_page, last_change, make_etag
+from flaskblog.database import read_only
+from flaskblog.feeds import SITE_TITLE, atom_feed, json_feed, feed_posts
+from flaskblog.pagination import paginate_keyset
+from flaskblog.queries import post_feed
+from flaskblog.search import search_posts
 from flask_login import login_user, current_user, logout_user, login_required
 
 
+#the navigation bar differs for logged in users, so cached pages are kept per view
+def page_view():
+    ''' this is a function to get the view part of a page cache key. 'auth' or 'anon'.'''
+    return 'auth' if current_user.is_authenticated else 'anon'
+
+
+#tags of a cached list page. editing a listed post or renaming a listed author drops the page.
+def list_tags(posts, *tags):
+    ''' this is a function to collect the cache tags of a page of posts.
+
+    Args:
+        posts: the posts shown on the page
+        tags: extra tags, e.g. 'feed' for the home page
+
+    Return:
+        the tags 'post:<id>' and 'user:<author id>' of every listed post, plus the extra tags.
+    '''
+    return list(tags) + ['post:%d' % p.id for p in posts] + ['user:%d' % p.user_id for p in posts]
+
+
 #after clicking the home button, redirect to the 'home.html'.
 @app.route("/")
 @app.route("/home")
+@read_only
 def home():
     ''' this is a function used to redirect the users to the homepage. list the posts by order. limit the num of posts by paginate.
 
     Args:
         page: start from page 1
-        posts: query the post data, order them by post.date_posted, max posts per_page=5
+        cursor: token of the next / previous page, see flaskblog/pagination.py
+        posts: query the post data with their authors joined, order them by post.date_posted, max posts per_page=5
 
     Return:
-        render 'home.html' page.
+        render 'home.html' page, or serve it from the cache. 304 if the browser has the current page.
     '''
     page = request.args.get('page', 1, type=int)
-    #limit the numbers of posts per page to 5.
-    posts = Post.query.order_by(Post.date_posted.desc()).paginate(page=page, per_page=5)
-    #render the 'home.html'
-    return render_template('home.html', posts=posts)
+    cursor = request.args.get('cursor')
+    #new and deleted posts bump 'feed', renamed users and new pictures bump 'authors'
+    last_modified = last_change(db.session.query(func.max(Post.updated_at)).scalar(), 'feed', 'authors')
+    etag = make_etag('home', page, cursor, page_view(), last_modified,
+                     cache.tag_version('feed'), cache.tag_version('authors'))
+
+    def render():
+        #limit the numbers of posts per page to 5. the largest id is a cheap estimate of the post count.
+        posts = paginate_keyset(post_feed(), cursor=cursor, page=page, per_page=5,
+                                count=lambda: db.session.query(func.max(Post.id)).scalar() or 0)
+        #render the 'home.html'
+        return render_template('home.html', posts=posts), list_tags(posts.items, 'feed')
+    return conditional_page(etag, last_modified,
+                            lambda: cache.page('home:%s:%s:%s' % (page, cursor, page_view()), render))
 
 
 #after clicking the about button, redirect to the 'about.html' page.
@@ -39,6 +77,38 @@ def about():
     '''
     return render_template('about.html', title='About')
 
+#show the fields the unique constraints refused as form errors, like the validators do
+def _taken_errors(form, fields):
+    for field in fields:
+        getattr(form, field).errors.append('That %s is taken. Please choose a different one.' % field)
+    if not fields:
+        flash('Your account could not be saved. Please try again.', 'danger')
+
+
+#this function answers the live username/email checks of the register and account forms
+@app.route("/api/availability")
+def availability_check():
+    ''' this is a function to check usernames and emails while they are typed, see static/availability.js.
+
+    Args:
+        request.args: username and/or email to check
+
+    Return:
+        json {field: {'value': ..., 'available': bool}}. the current user's own values are available.
+    '''
+    result = {}
+    for field in availability.FIELDS:
+        value = request.args.get(field, '').strip()
+        if not value:
+            continue
+        mine = (current_user.is_authenticated and
+                availability.normalize(value) == availability.normalize(getattr(current_user, field)))
+        result[field] = {'value': value, 'available': mine or not availability.index.is_taken(field, value)}
+    response = app.json.response(result)
+    #the answer changes with every registration, never keep it
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 #this function check if the register info is valid, and create new account based on the input
 @app.route("/register", methods=['GET', 'POST'])
 def register():
@@ -48,7 +118,7 @@ def register():
     Args:
         form: load the RegistrationForm
         user: data package, including username, email, and password
-        hashed_password: use bcrypt to generate a hash for the password
+        hashed_password: use bcrypt to generate a hash for the password, see flaskblog/hashing.py
 
     Return:
         add the user data to the record, commit it by db.
@@ -63,10 +133,19 @@ def register():
     form = RegistrationForm()
     #if the input is valid, create new account via db
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        #hash on the bounded bcrypt executor. answers 503 if it is saturated
+        hashed_password = hashing.generate_password_hash(form.password.data)
         user = User(username=form.username.data, email=form.email.data, password=hashed_password)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            #taken by a request the index has not seen yet, e.g. of another worker. the constraint is the final check
+            db.session.rollback()
+            _taken_errors(form, availability.conflicts(form.username.data, form.email.data))
+            return render_template('register.html', title='Register', form=form)
+        availability.index.replace('username', None, user.username)
+        availability.index.replace('email', None, user.email)
         #provide feedback to the users to inform the new account is created
         flash('Your account has been created! You are now able to log in', 'success')
         return redirect(url_for('login'))
@@ -91,6 +170,7 @@ def login():
         render 'login.html' page
         load the user data by email via query
         use bcrypt to check if user.password and form.password.data is the same
+        rehash the password if it was hashed with fewer rounds than configured
         if same, flash a feedback string and redirect to 'home.html' page
         if not same, flash a feedback string and stay at the 'login.html' page
     '''
@@ -102,7 +182,14 @@ def login():
     #check if username and the password match the record via query. if match, go batck to home page
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        if user and hashing.check_password_hash(user.password, form.password.data):
+            #upgrade hashes made with fewer rounds than BCRYPT_LOG_ROUNDS, while we know the password
+            if hashing.needs_rehash(user.password):
+                try:
+                    user.password = hashing.generate_password_hash(form.password.data)
+                    db.session.commit()
+                except hashing.HashingBusy:
+                    pass
             login_user(user, remember=form.remember.data)
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('home'))
@@ -121,33 +208,30 @@ def logout():
     return redirect(url_for('home'))
 
 
-#resize the picture to a 125x125 thumbnail. save it to the picture_path
-def save_picture(form_picture):
-    ''' this is a function to save the uploaded image to a thumbnail.
+#queue the picture for resizing. the renditions are written by a background job after the commit.
+def save_picture(picture_bytes, user_id):
+    ''' this is a function to hand the uploaded image over to flaskblog/avatars.py.
 
     Args:
-        random_hex, _, f_ext: load the picture file from the form, split its name by fil true ename and file extension name
-        picture_fn: recreate the new file name by adding these 2 names together
-        picture_path: the path for the new picture file
-        output_size: the size of the thumbnail
-        i: open the image
+        picture_bytes: the upload, already checked by UpdateAccountForm.validate_picture
+        user_id: the owner of the picture
 
     Return:
-        save the picture to the path
-        resize the picture to 125x125
-        resave the picture to the path
+        True if the picture was queued. False if the queue is full.
+        the user keeps the old picture until the 32/64/125/250px jpeg and webp renditions are written.
     '''
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(app.root_path, 'static/profile_pics', picture_fn)
-
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
-
-    return picture_fn
+    try:
+        avatars.submit(picture_bytes, user_id)
+    except avatars.AvatarBusy:
+        return False
+    return True
+
+#queue a job that writes the feeds a post change dropped from the cache again
+def warm_feeds(user_id):
+    ''' this is a function to refresh the site feeds and the feed of user_id in the background.'''
+    #queued after the invalidation, so the worker can not write a feed the invalidation drops again
+    jobs.enqueue('warm-feeds', {'base_url': request.url_root, 'user_id': user_id})
+    db.session.commit()
 
 #enable the user to update account information
 @app.route("/account", methods=['GET', 'POST'])
@@ -159,7 +243,7 @@ def account():
         form: load the UpdateAccountForm here
         form.username.data: username input from the form
         form.email.data: email input from the form
-        picture_file: save the uploaded picture file
+        form.picture.bytes: the checked upload, queued for processing by save_picture
         current_user.image: user profile image in the record
         current_user.name: username in the record
         current_user.email: user email in the record
@@ -174,23 +258,54 @@ def account():
     #check if the input of the form is valid
     if form.validate_on_submit():
         #rewrite the record of the userdata(image_file,username,and email) with the new input
-        if form.picture.data:
-            picture_file = save_picture(form.picture.data)
-            current_user.image_file = picture_file
-        current_user.username = form.username.data
-        current_user.email = form.email.data
+        #the picture job is queued in the same transaction as the new username and email
+        queued = save_picture(form.picture.bytes, current_user.id) if form.picture.data else None
+        #current_user is a read-only snapshot, change the row itself
+        user = User.query.get(current_user.id)
+        #the username is shown on the cached pages. the picture is invalidated when it is processed.
+        changed = user.username != form.username.data
+        old_username, old_email = user.username, user.email
+        user.username = form.username.data
+        user.email = form.email.data
         #commit the change via db.
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            _taken_errors(form, availability.conflicts(form.username.data, form.email.data, current_user.id))
+            return render_template('account.html', title='Account', form=form)
+        availability.index.replace('username', old_username, user.username)
+        availability.index.replace('email', old_email, user.email)
+        forget_user(user.id)
+        if changed:
+            cache.invalidate('user:%d' % user.id, 'authors')
+        if queued:
+            flash('Your new picture is being processed and will show up in a moment.', 'info')
+        elif queued is False:
+            flash('Too many pictures are being processed. Please try again in a minute.', 'warning')
         #give a feedback and go back to the account page.
         flash('Your account has been updated!', 'success')
         return redirect(url_for('account'))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.email.data = current_user.email
-    image_file = url_for('static', filename='profile_pics/' + current_user.image_file)
-    #render 'account.html' page
-    return render_template('account.html', title='Account',
-                           image_file=image_file, form=form)
+    #render 'account.html' page. the picture is drawn by the avatar macro from current_user.image_file
+    return render_template('account.html', title='Account', form=form)
+
+#a request over MAX_CONTENT_LENGTH, see flaskblog/avatars.py. the account form shows it like its other errors
+@app.errorhandler(413)
+def request_too_large(error):
+    ''' this is a function to answer an upload that is too large.
+
+    Return:
+        the account page with the error under the picture field, status 413. the plain 413 page elsewhere.
+    '''
+    if request.endpoint != 'account' or not current_user.is_authenticated:
+        return error
+    #the body was not read, so the form starts from the stored values
+    form = UpdateAccountForm(formdata=None, username=current_user.username, email=current_user.email)
+    form.picture.errors = [avatars.too_large_message()]
+    return render_template('account.html', title='Account', form=form), 413
 
 #let the user create a new post
 @app.route("/post/new", methods=['GET', 'POST'])
@@ -214,9 +329,11 @@ def new_post():
     form = PostForm()
     if form.validate_on_submit():
         #store the input in these 3 variables: title, content, and author. add the new data via db.
-        post = Post(title=form.title.data, content=form.content.data, author=current_user)
+        post = Post(title=form.title.data, content=form.content.data, user_id=current_user.id)
         db.session.add(post)
         db.session.commit()
+        cache.invalidate('feed', 'feed:user:%d' % current_user.id)
+        warm_feeds(current_user.id)
         flash('Your post has been created!', 'success')
         return redirect(url_for('home'))
     #render 'create_post.html' page
@@ -225,6 +342,7 @@ def new_post():
 
 #when the user click on the post title, redirect them to the post page.
 @app.route("/post/<int:post_id>")
+@read_only
 def post(post_id):
     ''' this is a function to display the post.
 
@@ -232,11 +350,23 @@ def post(post_id):
         post: data package, get the post by query its id.
 
     Return:
-        render 'post.html' page.
+        render 'post.html' page, or serve it from the cache. 304 if the browser has the current page.
+        the update and delete buttons depend on the user, so logged in users have their own copy.
     
     '''
-    post = Post.query.get_or_404(post_id)
-    return render_template('post.html', title=post.title, post=post)
+    validators = db.session.query(Post.user_id, Post.updated_at).filter(Post.id == post_id).first()
+    if validators is None:
+        abort(404)
+    def render():
+        post = post_feed(content=True).filter(Post.id == post_id).first_or_404()
+        html = render_template('post.html', title=post.title, post=post)
+        return html, ['post:%d' % post.id, 'user:%d' % post.user_id]
+    view = 'user%d' % current_user.id if current_user.is_authenticated else 'anon'
+    etag = make_etag('post', post_id, view, validators.updated_at, cache.tag_version('user:%d' % validators.user_id))
+    #a renamed author or a new picture bumps 'user:<id>'
+    last_modified = last_change(validators.updated_at, 'user:%d' % validators.user_id)
+    return conditional_page(etag, last_modified,
+                            lambda: cache.page('post:%d:%s' % (post_id, view), render))
 
 #function to let the user update a post
 @app.route("/post/<int:post_id>/update", methods=['GET', 'POST'])
@@ -260,14 +390,17 @@ def update_post(post_id):
     '''
     post = Post.query.get_or_404(post_id)
     #check if the current user is also the author of the post
-    if post.author != current_user:
+    if post.user_id != current_user.id:
         abort(403)
     form = PostForm()
     #change the title and the content of the post regarding the new input. commit the change via db.
     if form.validate_on_submit():
         post.title = form.title.data
         post.content = form.content.data
+        post.updated_at = datetime.utcnow()
         db.session.commit()
+        cache.invalidate('post:%d' % post.id)
+        warm_feeds(post.user_id)
         flash('Your post has been updated!', 'success')
         return redirect(url_for('post', post_id=post.id))
     elif request.method == 'GET':
@@ -294,11 +427,13 @@ def delete_post(post_id):
     '''
     post = Post.query.get_or_404(post_id)
     #check if the current user is also the author of the post
-    if post.author != current_user:
+    if post.user_id != current_user.id:
         abort(403)
     #commit change via db
     db.session.delete(post)
     db.session.commit()
+    cache.invalidate('post:%d' % post_id, 'feed', 'feed:user:%d' % current_user.id)
+    warm_feeds(current_user.id)
     #give user a feedback
     flash('Your post has been deleted!', 'success')
     #go back to home page
@@ -306,22 +441,122 @@ def delete_post(post_id):
 
 #sort the posts by author
 @app.route("/user/<string:username>")
+@read_only
 def user_posts(username):
     ''' this is a function to sort the posts by author.
     
     Args：
         page: start from page 1
+        cursor: token of the next / previous page, see flaskblog/pagination.py
         user: user data. here query the user data by username
         posts: post data package. here query the posts by author. order the posts by date_posted. limit the num per_page by paginate.
     
     Return:
         query the posts by author
-        redirect to the 'user_posts.html' page
+        redirect to the 'user_posts.html' page, or serve it from the cache. 304 if the browser has the current page.
     '''
     page = request.args.get('page', 1, type=int)
-    #query the posts via username
-    user = User.query.filter_by(username=username).first_or_404()
-    #maximum of 5 posts per page. list the posts via the time order
-    posts = Post.query.filter_by(author=user).order_by(Post.date_posted.desc()).paginate(page=page, per_page=5)
-    #render 'user_posts.html' page
-    return render_template('user_posts.html', posts=posts, user=user)
+    cursor = request.args.get('cursor')
+    author = db.session.query(User.id).filter_by(username=username).first_or_404()
+    last_modified = last_change(db.session.query(func.max(Post.updated_at)).filter(Post.user_id == author.id).scalar(),
+                                'user:%d' % author.id, 'feed:user:%d' % author.id)
+    etag = make_etag('user_posts', username, page, cursor, page_view(), last_modified,
+                     cache.tag_version('user:%d' % author.id), cache.tag_version('feed:user:%d' % author.id))
+
+    def render():
+        #query the posts via username
+        user = User.query.filter_by(username=username).first_or_404()
+        #maximum of 5 posts per page. list the posts via the time order. the total is kept on the user row.
+        posts = paginate_keyset(post_feed(user.id), cursor=cursor, page=page, per_page=5,
+                                count=lambda: user.post_count)
+        #render 'user_posts.html' page
+        html = render_template('user_posts.html', posts=posts, user=user)
+        return html, list_tags(posts.items, 'user:%d' % user.id, 'feed:user:%d' % user.id)
+    return conditional_page(etag, last_modified,
+                            lambda: cache.page('user_posts:%s:%s:%s:%s' % (username, page, cursor, page_view()), render))
+
+
+FEED_TYPES = {'atom': (atom_feed, 'application/atom+xml'), 'json': (json_feed, 'application/feed+json')}
+
+
+#the feeds are the same for everybody, so they are cached once and proxies may keep them
+def serve_feed(kind, author=None):
+    ''' this is a function to serve a feed.
+
+    Args:
+        kind: 'atom' or 'json'
+        author: row with the id and username of the author of a per-author feed. None for all posts
+
+    Return:
+        304 if the reader has the current feed. else the feed from the cache, or streamed entry by
+        entry while it is written and cached. new, updated and deleted posts drop only the feeds that list them.
+    '''
+    builder, mimetype = FEED_TYPES[kind]
+    last_modified = db.session.query(func.max(Post.updated_at))
+    if author is None:
+        key = 'feed:%s:%s' % (kind, request.host_url)
+        title, feed_tag = SITE_TITLE, 'feed'
+        page_tags = ('feed', 'authors')
+    else:
+        key = 'feed:%s:user%d:%s' % (kind, author.id, request.host_url)
+        title, feed_tag = '%s - %s' % (SITE_TITLE, author.username), 'feed:user:%d' % author.id
+        page_tags = ('feed:user:%d' % author.id, 'user:%d' % author.id)
+        last_modified = last_modified.filter(Post.user_id == author.id)
+    #deleted posts and renamed authors change the feed too, see last_change
+    last_modified = last_change(last_modified.scalar(), *page_tags)
+    etag = make_etag(key, last_modified, *[cache.tag_version(tag) for tag in page_tags])
+    feed_url = request.base_url
+
+    def generate(tags):
+        tags.append(feed_tag)
+        posts = feed_posts(author.id if author is not None else None)
+        return builder(posts, title, feed_url, last_modified or datetime.utcnow(), tags)
+
+    def render():
+        return Response(stream_with_context(cache.stream(key, generate)), mimetype=mimetype)
+    return conditional_page(etag, last_modified, render, public=True)
+
+
+@app.route("/feed.atom")
+@read_only
+def feed_atom():
+    ''' this is a function to serve the Atom feed of the newest posts.'''
+    return serve_feed('atom')
+
+
+@app.route("/feed.json")
+@read_only
+def feed_json():
+    ''' this is a function to serve the JSON feed of the newest posts.'''
+    return serve_feed('json')
+
+
+@app.route("/user/<string:username>/feed.atom")
+@read_only
+def user_feed_atom(username):
+    ''' this is a function to serve the Atom feed of the newest posts of one author.'''
+    author = db.session.query(User.id, User.username).filter_by(username=username).first_or_404()
+    return serve_feed('atom', author)
+
+
+#full-text search over the titles and contents of the posts
+@app.route("/search")
+@read_only
+def search():
+    ''' this is a function to search the posts.
+
+    Args:
+        q: the search text
+        cursor: token of the next page of results
+
+    Return:
+        render 'search.html' page with the best matches first, 10 per page.
+    '''
+    q = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor')
+    try:
+        results = search_posts(q, cursor=cursor, per_page=10)
+    except OperationalError:
+        #no FTS5 in this SQLite, or the index was never created (run flask blog upgrade-db)
+        abort(503)
+    return render_template('search.html', title='Search', q=q, results=results)
@@ -0,0 +1,160 @@
+'''full-text search over the posts with an SQLite FTS5 index kept in sync by triggers'''
+import base64
+import binascii
+import json
+import logging
+from flask import abort
+from markupsafe import Markup, escape
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from flaskblog import db
+from flaskblog.models import Post
+from flaskblog.queries import post_feed
+
+logger = logging.getLogger(__name__)
+
+#external content table: the text lives in post, the index only stores the tokens
+SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(
+        title, content, content='post', content_rowid='id', tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN
+        INSERT INTO post_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title, content ON post BEGIN
+        INSERT INTO post_fts(post_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO post_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+]
+
+#a title match counts ten times a content match
+RANKED_SEARCH = """
+    SELECT id, score, snip FROM (
+        SELECT rowid AS id, bm25(post_fts, 10.0, 1.0) AS score,
+               snippet(post_fts, -1, char(2), char(3), '...', 24) AS snip
+        FROM post_fts WHERE post_fts MATCH :query)
+    WHERE :first OR score > :score OR (score = :score AND id > :id)
+    ORDER BY score, id LIMIT :limit
+"""
+
+
+def create_index(connection):
+    ''' this is a function to create the FTS5 table and its triggers. safe to run many times.
+
+    Return:
+        True if the index exists. False if this SQLite has no FTS5.
+    '''
+    try:
+        for statement in SCHEMA:
+            connection.execute(text(statement))
+    except OperationalError:
+        logger.warning('SQLite was built without FTS5, search is disabled', exc_info=True)
+        return False
+    return True
+
+
+#new databases made by db.create_all get the index together with the post table
+@event.listens_for(Post.__table__, 'after_create')
+def _create_index_after_post(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        create_index(connection)
+
+
+#fill the index from the post table, batch_size posts per transaction
+def rebuild_index(batch_size=1000):
+    ''' this is a function to rebuild the search index of an existing database.
+
+    Return:
+        a generator of the number of posts indexed so far, one value per batch.
+    '''
+    with db.engine.begin() as conn:
+        if not create_index(conn):
+            return
+        conn.execute(text("INSERT INTO post_fts(post_fts) VALUES ('delete-all')"))
+    last_id, done = 0, 0
+    while True:
+        with db.engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(
+                text('SELECT id FROM post WHERE id > :last ORDER BY id LIMIT :n'),
+                {'last': last_id, 'n': batch_size})]
+            if not ids:
+                break
+            conn.execute(text('INSERT INTO post_fts(rowid, title, content) '
+                              'SELECT id, title, content FROM post WHERE id BETWEEN :lo AND :hi'),
+                         {'lo': ids[0], 'hi': ids[-1]})
+        last_id = ids[-1]
+        done += len(ids)
+        yield done
+    with db.engine.begin() as conn:
+        conn.execute(text("INSERT INTO post_fts(post_fts) VALUES ('optimize')"))
+
+
+#every word of the user input is a quoted term, so FTS5 operators in the input are just text
+def match_expression(query):
+    ''' this is a function to turn the search box input into an FTS5 query. the last word matches as a prefix.'''
+    terms = ['"%s"' % word.replace('"', '""') for word in query.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _snippet(raw):
+    return escape(raw).replace('\x02', Markup('<mark>')).replace('\x03', Markup('</mark>'))
+
+
+def _encode(score, post_id):
+    raw = json.dumps([score, post_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _decode(token):
+    try:
+        score, post_id = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        return float(score), int(post_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        abort(400)
+
+
+class SearchResults(object):
+    '''this is a page of search results.
+
+    Attributes:
+        items: list of (post, snippet). post.author is loaded, snippet is html with <mark> around the matches
+        next_cursor: token of the next page, or None on the last page
+
+    '''
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+
+#best matches first, paginated by keyset on (score, id)
+def search_posts(query, cursor=None, per_page=10):
+    ''' this is a function to search the posts.
+
+    Args:
+        query: the text from the search box
+        cursor: token from the previous page
+        per_page: max results per page
+
+    Return:
+        SearchResults. two queries: one on the index, one for the posts and their authors.
+    '''
+    expression = match_expression(query)
+    if not expression:
+        return SearchResults([], None)
+    score, last_id = _decode(cursor) if cursor else (0.0, 0)
+    rows = db.session.execute(text(RANKED_SEARCH), {
+        'query': expression, 'first': cursor is None, 'score': score, 'id': last_id,
+        'limit': per_page + 1}).fetchall()
+    next_cursor = _encode(rows[per_page - 1][1], rows[per_page - 1][0]) if len(rows) > per_page else None
+    rows = rows[:per_page]
+    if not rows:
+        return SearchResults([], None)
+    posts = dict((post.id, post) for post in
+                 post_feed().filter(Post.id.in_([row[0] for row in rows])))
+    items = [(posts[row[0]], _snippet(row[2])) for row in rows if row[0] in posts]
+    return SearchResults(items, next_cursor)
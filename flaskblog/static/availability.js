@@ -0,0 +1,43 @@
+// live username / email checks of the forms that have a data-availability-url
+(function () {
+  var fields = ['username', 'email'];
+
+  function show(input, available) {
+    var feedback = input.parentNode.querySelector('.availability-feedback');
+    if (!feedback) {
+      feedback = document.createElement('div');
+      feedback.className = 'invalid-feedback availability-feedback';
+      input.parentNode.appendChild(feedback);
+    }
+    feedback.textContent = available ? '' : 'That ' + input.name + ' is taken. Please choose a different one.';
+    input.classList.toggle('is-invalid', !available);
+  }
+
+  document.querySelectorAll('form[data-availability-url]').forEach(function (form) {
+    var url = form.getAttribute('data-availability-url');
+    fields.forEach(function (field) {
+      var input = form.elements[field];
+      var timer = null;
+      if (!input) {
+        return;
+      }
+      input.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+          var value = input.value.trim();
+          if (!value) {
+            return;
+          }
+          fetch(url + '?' + field + '=' + encodeURIComponent(value), {credentials: 'same-origin'})
+            .then(function (response) { return response.ok ? response.json() : null; })
+            .then(function (result) {
+              if (result && result[field] && input.value.trim() === value) {
+                show(input, result[field].available);
+              }
+            })
+            .catch(function () {});
+        }, 250);
+      });
+    });
+  });
+})();
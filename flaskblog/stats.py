@@ -0,0 +1,100 @@
+'''per-author statistics stored on the user row and kept up to date in the transaction that changes the posts'''
+from sqlalchemy import LargeBinary, cast, event, func, inspect, select
+from flaskblog import db
+from flaskblog.models import User, Post
+
+
+def content_size(content):
+    ''' this is a function to get the size of a post content in bytes, the way sqlite counts a utf-8 blob.'''
+    return len((content or '').encode('utf-8'))
+
+
+#relative updates, so two requests writing posts of the same author at the same time both count
+def _adjust(connection, user_id, posts, content_bytes):
+    user, post = User.__table__, Post.__table__
+    #the newest post is looked up again, a deleted post may have been the newest. it reads the (user_id, date_posted) index
+    newest = select(func.max(post.c.date_posted)).where(post.c.user_id == user_id).scalar_subquery()
+    connection.execute(user.update().where(user.c.id == user_id).values(
+        post_count=user.c.post_count + posts, content_bytes=user.c.content_bytes + content_bytes,
+        last_post_at=newest))
+
+
+#load the old author and content when they are replaced, even if they were expired by a commit,
+#so after_update knows whose statistics to move and by how many bytes
+@event.listens_for(Post.user_id, 'set', active_history=True)
+@event.listens_for(Post.content, 'set', active_history=True)
+def _keep_old_value(post, value, oldvalue, initiator):
+    pass
+
+
+#the mapper events run inside the flush, on its connection, so the stats commit or roll back with the post
+@event.listens_for(Post, 'after_insert')
+def _post_inserted(mapper, connection, post):
+    _adjust(connection, post.user_id, 1, content_size(post.content))
+
+
+@event.listens_for(Post, 'after_delete')
+def _post_deleted(mapper, connection, post):
+    if 'content' in inspect(post).unloaded:
+        #deleted without reading the content, its size is unknown. the row is gone, so count the rest
+        reconcile(connection, [post.user_id])
+    else:
+        _adjust(connection, post.user_id, -1, -content_size(post.content))
+
+
+@event.listens_for(Post, 'after_update')
+def _post_updated(mapper, connection, post):
+    state = inspect(post)
+    author = state.attrs.user_id.history
+    content = state.attrs.content.history
+    if not author.has_changes() and not content.has_changes():
+        return
+    if 'content' in state.unloaded or (content.has_changes() and not content.deleted):
+        #the old content was never loaded, so its size is unknown. count the authors from scratch
+        reconcile(connection, [post.user_id] + list(author.deleted))
+        return
+    old_content = content.deleted[0] if content.deleted else post.content
+    if author.has_changes() and author.deleted:
+        #the post was given to another author
+        _adjust(connection, author.deleted[0], -1, -content_size(old_content))
+        _adjust(connection, post.user_id, 1, content_size(post.content))
+    else:
+        _adjust(connection, post.user_id, 0, content_size(post.content) - content_size(old_content))
+
+
+def reconcile(connection, user_ids):
+    ''' this is a function to recompute the statistics of some users from their posts.
+
+    Args:
+        connection: the connection of the current transaction
+        user_ids: the users to recompute
+
+    '''
+    user, post = User.__table__, Post.__table__
+    mine = post.c.user_id == user.c.id
+    connection.execute(user.update().where(user.c.id.in_(user_ids)).values(
+        post_count=select(func.count(post.c.id)).where(mine).scalar_subquery(),
+        last_post_at=select(func.max(post.c.date_posted)).where(mine).scalar_subquery(),
+        content_bytes=select(func.coalesce(func.sum(func.length(cast(post.c.content, LargeBinary))), 0))
+        .where(mine).scalar_subquery()))
+
+
+#recompute every user, batch_size users per transaction, e.g. after an import that bypassed the ORM
+def reconcile_all(batch_size=1000):
+    ''' this is a function to rebuild the statistics of every user.
+
+    Return:
+        a generator of the number of users done so far, one value per batch.
+    '''
+    table = User.__table__
+    last_id, done = 0, 0
+    while True:
+        with db.engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(
+                select(table.c.id).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size))]
+            if not ids:
+                break
+            reconcile(conn, ids)
+        last_id = ids[-1]
+        done += len(ids)
+        yield done
@@ -0,0 +1,96 @@
+'''content addressed storage of the profile pictures under static/profile_pics'''
+import hashlib
+import os
+import time
+from flaskblog import app
+
+#pictures are stored as ab/cd/<hash>, so no directory holds more than a few thousand files
+SHARD_LEVELS = 2
+#names that are never collected
+PROTECTED = frozenset(['default.jpg', '.DS_Store'])
+
+
+def picture_root():
+    return os.path.join(app.root_path, 'static', 'profile_pics')
+
+
+#the name of a picture is the sha256 of its upload, so the same picture is only stored once
+def content_name(data):
+    ''' this is a function to get the storage name of an upload.
+
+    Args:
+        data: bytes of the upload
+
+    Return:
+        the name without extension, e.g. '3f/a2/3fa2...'. the sha256 is cut to 32 hex characters.
+    '''
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    shards = [digest[2 * i:2 * i + 2] for i in range(SHARD_LEVELS)]
+    return '/'.join(shards + [digest])
+
+
+#a stored file never changes, a new picture gets a new name. so they can be cached forever
+def is_content_name(rel_path):
+    ''' this is a function to tell if a path relative to the picture root is a stored picture, e.g. ab/cd/<hash>_64.webp'''
+    parts = rel_path.split('/')
+    if len(parts) != SHARD_LEVELS + 1:
+        return False
+    digest = parts[-1].split('.', 1)[0].split('_', 1)[0]
+    if len(digest) != 32 or digest.strip('0123456789abcdef'):
+        return False
+    return parts[:-1] == [digest[2 * i:2 * i + 2] for i in range(SHARD_LEVELS)]
+
+
+def path_of(name):
+    ''' this is a function to get the file path of a stored name, e.g. the User.image_file.'''
+    return os.path.join(picture_root(), *name.split('/'))
+
+
+def exists(name):
+    return os.path.exists(path_of(name))
+
+
+def make_dirs(name):
+    os.makedirs(os.path.dirname(path_of(name)), exist_ok=True)
+
+
+#the names a file may be referenced by in User.image_file
+def referenced_as(rel_path):
+    ''' this is a function to get the User.image_file values that keep a file alive.
+
+    Return:
+        the file itself, and for a rendition like ab/cd/<hash>_64.webp its primary ab/cd/<hash>.jpg
+    '''
+    folder, filename = os.path.split(rel_path)
+    base = filename.split('.', 1)[0].split('_', 1)[0]
+    primary = base + '.jpg'
+    if folder:
+        primary = folder + '/' + primary
+    return set([rel_path, primary])
+
+
+#walk the picture folder lazily, one directory at a time
+def iter_files(min_age=0):
+    ''' this is a function to list the stored pictures without loading the whole tree in memory.
+
+    Args:
+        min_age: skip files modified less than this many seconds ago. they may belong to an upload still being saved
+
+    Return:
+        a generator of paths relative to the picture root, with '/' separators
+    '''
+    root = picture_root()
+    deadline = time.time() - min_age
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        rel_folder = os.path.relpath(folder, root).replace(os.sep, '/')
+        for filename in sorted(files):
+            if filename in PROTECTED:
+                continue
+            path = os.path.join(folder, filename)
+            try:
+                if os.stat(path).st_mtime > deadline:
+                    continue
+            except OSError:
+                continue
+            yield filename if rel_folder == '.' else rel_folder + '/' + filename
@@ -0,0 +1,70 @@
+'''helpers to check how many SQL statements a piece of code runs'''
+from contextlib import contextmanager
+from sqlalchemy import event
+from flaskblog import app, db
+
+
+class QueryCounter(object):
+    '''this is a class to record the SQL statements sent to the database engine.
+
+    Attributes:
+        statements: the SQL text of every statement run inside the with block
+
+    '''
+
+    def __init__(self):
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        #every engine, the production profile reads through a second one
+        with app.app_context():
+            self._engines = list(db.engines.values())
+        for engine in self._engines:
+            event.listen(engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        for engine in self._engines:
+            event.remove(engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+#fail if the block runs more SQL statements than expected
+@contextmanager
+def assert_max_queries(expected):
+    ''' this is a function to guard a block against N+1 query regressions.
+
+    Args:
+        expected: the max number of SQL statements the block may run
+
+    Return:
+        the QueryCounter of the block. raise AssertionError listing the statements if there are too many.
+    '''
+    with QueryCounter() as counter:
+        yield counter
+    if counter.count > expected:
+        raise AssertionError('%d SQL statements were run, expected at most %d:\n%s'
+                             % (counter.count, expected, '\n'.join(counter.statements)))
+
+
+#request a route through the test client and check its SQL statement count
+def assert_route_queries(client, url, expected, **kwargs):
+    ''' this is a function to check the number of SQL statements a route issues.
+
+    Args:
+        client: app.test_client(). log in with it first to check the authenticated view
+        url: the url to request
+        expected: the max number of SQL statements
+        kwargs: passed to client.get, e.g. headers
+
+    Return:
+        the response. raise AssertionError if the route runs more statements than expected.
+    '''
+    with app.app_context(), assert_max_queries(expected):
+        return client.get(url, **kwargs)
@@ -0,0 +1,121 @@
+'''streaming JSONL export and import of the users and posts'''
+import gzip
+import io
+import json
+import sys
+from datetime import datetime
+from sqlalchemy import DateTime
+from flaskblog import db
+from flaskblog.models import User, Post
+
+#users are written first, so every post finds its author when the file is read back
+TABLES = (('user', User.__table__), ('post', Post.__table__))
+
+
+def open_file(path, mode):
+    ''' this is a function to open an export file. '-' is stdin / stdout, a name ending in .gz is gzip.'''
+    if path == '-':
+        stream = sys.stdout if mode == 'w' else sys.stdin
+        return io.TextIOWrapper(stream.buffer, encoding='utf-8') if hasattr(stream, 'buffer') else stream
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+#read a table in id order, batch_size rows per query, so memory stays flat
+def iter_rows(table, batch_size=1000):
+    ''' this is a function to stream all rows of a table as dicts.'''
+    last_id = 0
+    while True:
+        result = db.session.execute(table.select().where(table.c.id > last_id)
+                                    .order_by(table.c.id).limit(batch_size))
+        keys = list(result.keys())
+        rows = result.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield dict(zip(keys, row))
+        last_id = rows[-1].id
+
+
+def export_rows(f, batch_size=1000):
+    ''' this is a function to write every user and post as one JSON object per line.
+
+    Args:
+        f: the text file to write to
+        batch_size: rows read per query
+
+    Return:
+        a generator of the number of rows written so far, one value per row.
+    '''
+    count = 0
+    for kind, table in TABLES:
+        for row in iter_rows(table, batch_size):
+            row = dict((key, _encode(value)) for key, value in row.items())
+            row['type'] = kind
+            f.write(json.dumps(row, separators=(',', ':')))
+            f.write('\n')
+            count += 1
+            yield count
+
+
+def _decoder(table):
+    #the columns that have to be turned back from iso strings into datetimes
+    dates = [column.name for column in table.columns if isinstance(column.type, DateTime)]
+    names = set(column.name for column in table.columns)
+
+    def decode(row):
+        row = dict((key, value) for key, value in row.items() if key in names)
+        for name in dates:
+            if row.get(name) is not None:
+                row[name] = datetime.fromisoformat(row[name])
+        return row
+    return decode
+
+
+def import_rows(f, batch_size=5000):
+    ''' this is a function to load a file written by export_rows.
+
+    Args:
+        f: the text file to read from
+        batch_size: rows inserted per executemany, and per transaction
+
+    Return:
+        a generator of the number of rows inserted so far, one value per batch.
+        ids and password hashes are kept as they are. unknown keys are ignored.
+    '''
+    tables = dict(TABLES)
+    decoders = dict((kind, _decoder(table)) for kind, table in TABLES)
+    batches = dict((kind, []) for kind in tables)
+    count = 0
+
+    def flush(kind):
+        batch = batches[kind]
+        #one transaction per batch: executemany over a prepared INSERT
+        with db.engine.begin() as conn:
+            conn.execute(tables[kind].insert(), batch)
+        batches[kind] = []
+        return len(batch)
+
+    for line in f:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        kind = row.pop('type', None) if isinstance(row, dict) else None
+        if kind not in tables:
+            raise ValueError('unknown row type %r' % kind)
+        batches[kind].append(decoders[kind](row))
+        if len(batches[kind]) >= batch_size:
+            #a post batch may hold authors that are still in the user batch
+            if kind == 'post' and batches['user']:
+                count += flush('user')
+            count += flush(kind)
+            yield count
+    for kind, _ in TABLES:
+        if batches[kind]:
+            count += flush(kind)
+            yield count
@@ -0,0 +1,80 @@
+'''pytest fixtures: the app on a throwaway sqlite database, emptied before every test'''
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+#the engine is created when flaskblog is imported, so the database is chosen first
+_folder = tempfile.mkdtemp(prefix='flaskblog-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_folder, 'test.db')
+os.environ['FLASKBLOG_CONFIG'] = 'development'
+
+import pytest
+from sqlalchemy import text
+from flaskblog import app as flask_app, db, cache, identity_cache, availability
+from flaskblog.models import User, Post
+
+flask_app.config.update(
+    TESTING=True,
+    WTF_CSRF_ENABLED=False,
+    BCRYPT_LOG_ROUNDS=4,
+    #the tests run the jobs themselves, see tests/test_jobs.py
+    JOBS_IN_APP=False,
+    AVATAR_SPOOL_DIR=os.path.join(_folder, 'uploads'),
+)
+
+
+@pytest.fixture(autouse=True)
+def database():
+    ''' this is a fixture to give every test empty tables, caches and availability index.'''
+    with flask_app.app_context():
+        db.session.remove()
+        with db.engine.begin() as conn:
+            conn.execute(text('DROP TABLE IF EXISTS post_fts'))
+        db.drop_all()
+        #the search index is made with the post table, see flaskblog/search.py
+        db.create_all()
+    cache.clear()
+    identity_cache.clear()
+    availability.index.build()
+    yield
+    with flask_app.app_context():
+        db.session.remove()
+
+
+#no app context is held around the test: a request would reuse it, and with it g and the logged in user
+@pytest.fixture
+def app():
+    return flask_app
+
+
+@pytest.fixture
+def client():
+    return flask_app.test_client()
+
+
+def make_user(name, password='x'):
+    ''' this is a function to add a user named name, with the email <name>@example.com. return its id.'''
+    with flask_app.app_context():
+        user = User(username=name, email='%s@example.com' % name, password=password)
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def make_posts(user_id, count, start=None, content='Some words of a post.'):
+    ''' this is a function to add count posts of user_id, one minute apart, the last one the newest. return their ids.'''
+    start = start or datetime(2020, 1, 1)
+    with flask_app.app_context():
+        posts = [Post(title='Post %d' % number, content=content, user_id=user_id,
+                      date_posted=start + timedelta(minutes=number), updated_at=start + timedelta(minutes=number))
+                 for number in range(count)]
+        db.session.add_all(posts)
+        db.session.commit()
+        return [post.id for post in posts]
+
+
+def login(client, user_id):
+    ''' this is a function to log a test client in without checking a password.'''
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
@@ -0,0 +1,43 @@
+'''the json api, see flaskblog/api.py'''
+from sqlalchemy import update
+from flaskblog import db
+from flaskblog.models import Post
+from flaskblog.rendering import render_html
+from conftest import make_user, make_posts
+
+
+def test_posts_newest_first_by_cursor(app, client):
+    make_posts(make_user('author'), 5)
+    titles, url = [], '/api/posts?limit=2'
+    while url:
+        answer = client.get(url).get_json()
+        titles.extend(post['title'] for post in answer['posts'])
+        url = answer['next']
+    assert titles == ['Post %d' % number for number in range(4, -1, -1)]
+
+
+def test_ids_in_the_asked_order(app, client):
+    first, second = make_posts(make_user('author'), 2)
+    answer = client.get('/api/posts?ids=%d,999,%d&fields=id,author' % (second, first)).get_json()
+    assert answer == {'posts': [{'id': second, 'author': 'author'}, {'id': first, 'author': 'author'}],
+                      'missing': [999]}
+
+
+def test_unknown_field(app, client):
+    assert client.get('/api/posts?fields=id,password').status_code == 400
+
+
+def test_content_html_without_id(app, client):
+    post_id = make_posts(make_user('author'), 1, content='Some *words*.')[0]
+    #a post stored before render-on-write
+    with app.app_context():
+        db.session.execute(update(Post).where(Post.id == post_id).values(content_html=None))
+        db.session.commit()
+    for url in ('/api/posts?fields=content_html', '/api/posts?ids=%d&fields=content_html' % post_id):
+        response = client.get(url)
+        assert response.status_code == 200, url
+        assert response.get_json()['posts'] == [{'content_html': render_html('Some *words*.')}], url
+
+
+def test_unknown_user(app, client):
+    assert client.get('/api/users/nobody/posts').status_code == 404
@@ -0,0 +1,56 @@
+'''the index of the taken usernames and emails, see flaskblog/availability.py'''
+import pytest
+from flaskblog import availability
+from flaskblog.models import User
+from conftest import make_user, login
+
+
+def check(client, **values):
+    return dict((field, answer['available']) for field, answer in
+                client.get('/api/availability', query_string=values).get_json().items())
+
+
+def test_taken_and_free(app, client):
+    make_user('Author')
+    availability.index.build()
+    assert check(client, username=' author ', email='nobody@example.com') == {'username': False, 'email': True}
+
+
+def test_register_and_rename_update_the_index(app, client):
+    client.post('/register', data={'username': 'newcomer', 'email': 'newcomer@example.com',
+                                   'password': 'secret', 'confirm_password': 'secret'})
+    assert check(client, username='newcomer') == {'username': False}
+    with app.app_context():
+        user_id = User.query.filter_by(username='newcomer').first().id
+    login(client, user_id)
+    client.post('/account', data={'username': 'renamed', 'email': 'newcomer@example.com'})
+    #the user's own name is available to them
+    assert check(client, username='renamed') == {'username': True}
+    with app.app_context():
+        assert availability.index.is_taken('username', 'renamed')
+        assert not availability.index.is_taken('username', 'newcomer')
+
+
+def test_failed_build_lets_lookups_go(app, monkeypatch):
+    make_user('Author')
+    index = availability.AvailabilityIndex()
+
+    def broken():
+        raise RuntimeError('not a database error')
+    monkeypatch.setattr(index, '_load', broken)
+    with pytest.raises(RuntimeError):
+        index.build()
+    #no index, so the user table answers
+    with app.test_request_context():
+        assert index.is_taken('username', 'author')
+        assert not index.is_taken('username', 'someone')
+
+
+def test_lookups_stop_waiting_for_a_slow_build(app, monkeypatch):
+    make_user('author')
+    index = availability.AvailabilityIndex()
+    #a build that never ends
+    monkeypatch.setattr(index, 'refresh', lambda: None)
+    monkeypatch.setitem(app.config, 'AVAILABILITY_WAIT', 0.05)
+    with app.test_request_context():
+        assert index.is_taken('username', 'author')
@@ -0,0 +1,84 @@
+'''the rendered pages are cached and dropped by the writes that change them, see flaskblog/cache.py'''
+from flaskblog import cache
+from flaskblog.testing import QueryCounter
+from conftest import make_user, make_posts, login
+
+
+def get(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    return response.data.decode('utf-8')
+
+
+def test_pages_are_cached(app, client):
+    post_id = make_posts(make_user('author'), 1)[0]
+    for url in ('/', '/post/%d' % post_id, '/user/author'):
+        get(client, url)
+        with QueryCounter() as counter:
+            get(client, url)
+        #the validators of the page, nothing to render it
+        assert counter.count <= 2, url
+
+
+def test_update_post_drops_its_pages(app, client):
+    author = make_user('author')
+    post_id = make_posts(author, 1)[0]
+    pages = ('/', '/post/%d' % post_id, '/user/author')
+    for url in pages:
+        get(client, url)
+    login(client, author)
+    client.post('/post/%d/update' % post_id, data={'title': 'A new title', 'content': 'New words.'})
+    for url in pages:
+        assert 'A new title' in get(client, url), url
+
+
+def test_new_and_deleted_posts_change_the_lists(app, client):
+    author = make_user('author')
+    post_id = make_posts(author, 1)[0]
+    get(client, '/')
+    get(client, '/user/author')
+    login(client, author)
+    client.post('/post/new', data={'title': 'Fresh post', 'content': 'Words.'})
+    assert 'Fresh post' in get(client, '/')
+    assert 'Fresh post' in get(client, '/user/author')
+    client.post('/post/%d/delete' % post_id)
+    assert 'Post 0' not in get(client, '/')
+    assert client.get('/post/%d' % post_id).status_code == 404
+
+
+def test_renamed_author_drops_the_pages_listing_them(app, client):
+    author = make_user('author')
+    post_id = make_posts(author, 1)[0]
+    get(client, '/')
+    get(client, '/post/%d' % post_id)
+    login(client, author)
+    client.post('/account', data={'username': 'renamed', 'email': 'author@example.com'})
+    assert 'renamed' in get(client, '/')
+    assert 'renamed' in get(client, '/post/%d' % post_id)
+
+
+
+def test_page_invalidated_while_rendering_is_not_stored(app):
+    def render():
+        #a writer commits and invalidates while the page is being rendered
+        cache.invalidate('feed')
+        return 'stale', ['feed']
+
+    def generate(tags):
+        tags.append('feed')
+        yield 'stale'
+        cache.invalidate('feed')
+    with app.test_request_context():
+        cache.tag_version('feed')
+        assert cache.page('page', render) == 'stale'
+        assert cache.get('page') is None
+        assert cache.page('page', lambda: ('fresh', ['feed'])) == 'fresh'
+        assert cache.get('page') == 'fresh'
+        assert ''.join(cache.stream('feed', generate)) == 'stale'
+        assert cache.get('feed') is None
+
+
+def test_new_tags_are_stored(app):
+    with app.test_request_context():
+        cache.page('page', lambda: ('html', ['post:1']))
+        assert cache.get('page') == 'html'
@@ -0,0 +1,54 @@
+'''Last-Modified and If-Modified-Since of the list pages, see flaskblog/conditional.py'''
+import time
+from conftest import make_user, make_posts, login
+
+
+def modified_since(client, url, last_modified):
+    #only If-Modified-Since, like a client that does not keep etags
+    return client.get(url, headers={'If-Modified-Since': last_modified}).status_code
+
+
+def test_unchanged_page_is_not_modified(app, client):
+    make_posts(make_user('author'), 2)
+    last_modified = client.get('/').headers['Last-Modified']
+    assert modified_since(client, '/', last_modified) == 304
+
+
+def test_deleted_post_changes_last_modified(app, client):
+    author = make_user('author')
+    #the oldest post, so the newest updated_at stays the same
+    post_id = make_posts(author, 3)[0]
+    pages = ('/', '/user/author')
+    last_modified = dict((url, client.get(url).headers['Last-Modified']) for url in pages)
+    #http dates have whole seconds
+    time.sleep(1.1)
+    login(client, author)
+    #the redirect shows the flash message, pages with one are never answered 304
+    client.post('/post/%d/delete' % post_id, follow_redirects=True)
+    for url in pages:
+        assert modified_since(client, url, last_modified[url]) == 200, url
+
+
+def test_renamed_author_changes_last_modified(app, client):
+    author = make_user('author')
+    post_id = make_posts(author, 1)[0]
+    pages = ('/', '/post/%d' % post_id)
+    last_modified = dict((url, client.get(url).headers['Last-Modified']) for url in pages)
+    time.sleep(1.1)
+    login(client, author)
+    client.post('/account', data={'username': 'writer', 'email': 'author@example.com'}, follow_redirects=True)
+    for url in pages:
+        assert modified_since(client, url, last_modified[url]) == 200, url
+
+
+def test_feeds_change_last_modified(app, client):
+    author = make_user('author')
+    post_id = make_posts(author, 3)[0]
+    feeds = ('/feed.atom', '/feed.json', '/user/author/feed.atom')
+    last_modified = dict((url, client.get(url).headers['Last-Modified']) for url in feeds)
+    time.sleep(1.1)
+    login(client, author)
+    #the redirect shows the flash message, pages with one are never answered 304
+    client.post('/post/%d/delete' % post_id, follow_redirects=True)
+    for url in feeds:
+        assert modified_since(client, url, last_modified[url]) == 200, url
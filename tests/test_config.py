@@ -0,0 +1,29 @@
+'''the config profiles, see flaskblog/config.py'''
+import importlib
+import os
+from flaskblog import config
+
+
+def test_production_shares_the_caches():
+    #an lru cache is per process: invalidations would not reach the other workers
+    assert config.ProductionConfig.CACHE_TYPE == 'filesystem'
+    assert config.ProductionConfig.IDENTITY_CACHE_TYPE == 'filesystem'
+    assert not hasattr(config.DevelopmentConfig, 'CACHE_TYPE')
+
+
+def test_profiles_differ():
+    development, production = config.profiles['development'], config.profiles['production']
+    assert not development.SQLALCHEMY_READ_ENGINE and production.SQLALCHEMY_READ_ENGINE
+    assert production.SQLITE_PRAGMAS['journal_mode'] == 'WAL'
+    assert 'journal_mode' not in development.SQLITE_PRAGMAS
+
+
+def test_default_database_is_in_the_package():
+    #flask-sqlalchemy 3 would put a relative sqlite path under instance/
+    environ = os.environ.pop('DATABASE_URL')
+    try:
+        default = importlib.reload(config).Config.SQLALCHEMY_DATABASE_URI
+    finally:
+        os.environ['DATABASE_URL'] = environ
+        importlib.reload(config)
+    assert default == 'sqlite:///' + os.path.join(os.path.dirname(os.path.abspath(config.__file__)), 'site.db')
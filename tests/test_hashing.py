@@ -0,0 +1,69 @@
+'''bcrypt on a bounded executor, see flaskblog/hashing.py'''
+import threading
+from flaskblog import db, hashing
+from flaskblog.models import User
+from conftest import make_user
+
+
+def make_login(app, name, password, rounds):
+    with app.app_context():
+        pw_hash = hashing.bcrypt.generate_password_hash(password, rounds).decode('utf-8')
+    return make_user(name, password=pw_hash)
+
+
+def stored_hash(app, user_id):
+    with app.app_context():
+        return db.session.get(User, user_id).password
+
+
+def log_in(client, name, password):
+    return client.post('/login', data={'email': '%s@example.com' % name, 'password': password})
+
+
+def test_full_executor_answers_503(app, client, monkeypatch):
+    make_login(app, 'author', 'secret', 4)
+    #every slot is taken, as by other requests that are still hashing
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(hashing, '_slots', slots)
+    monkeypatch.setitem(app.config, 'HASH_QUEUE_TIMEOUT', 0)
+    rejected = hashing.stats.snapshot()['rejected']
+    response = log_in(client, 'author', 'secret')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert hashing.stats.snapshot()['rejected'] == rejected + 1
+    #a slot is free again, the same login goes through
+    slots.release()
+    assert log_in(client, 'author', 'secret').status_code == 302
+
+
+def test_login_rehashes_with_the_new_cost(app, client, monkeypatch):
+    user_id = make_login(app, 'author', 'secret', 4)
+    old_hash = stored_hash(app, user_id)
+    monkeypatch.setitem(app.config, 'BCRYPT_LOG_ROUNDS', 5)
+    assert log_in(client, 'author', 'secret').status_code == 302
+    new_hash = stored_hash(app, user_id)
+    assert old_hash.split('$')[2] == '04'
+    assert new_hash.split('$')[2] == '05'
+    with app.app_context():
+        assert hashing.check_password_hash(new_hash, 'secret')
+    #the cost is current now, the next login keeps the hash
+    client.get('/logout')
+    assert log_in(client, 'author', 'secret').status_code == 302
+    assert stored_hash(app, user_id) == new_hash
+
+
+def test_wrong_password_keeps_the_old_hash(app, client, monkeypatch):
+    user_id = make_login(app, 'author', 'secret', 4)
+    old_hash = stored_hash(app, user_id)
+    monkeypatch.setitem(app.config, 'BCRYPT_LOG_ROUNDS', 5)
+    assert log_in(client, 'author', 'wrong').status_code == 200
+    assert stored_hash(app, user_id) == old_hash
+
+
+def test_needs_rehash(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'BCRYPT_LOG_ROUNDS', 12)
+    assert hashing.needs_rehash('$2b$10$' + 'x' * 53)
+    assert not hashing.needs_rehash('$2b$12$' + 'x' * 53)
+    assert not hashing.needs_rehash('$2b$13$' + 'x' * 53)
+    assert hashing.needs_rehash('plain text')
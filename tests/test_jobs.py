@@ -0,0 +1,122 @@
+'''the job queue, see flaskblog/jobs.py, and the avatar uploads it runs, see flaskblog/avatars.py'''
+import io
+import os
+import threading
+from datetime import datetime, timedelta
+from PIL import Image
+from sqlalchemy.exc import OperationalError
+from flaskblog import db, jobs, avatars
+from flaskblog.models import Job
+from conftest import make_user
+
+calls = []
+
+
+@jobs.handler('test-ok')
+def ok(payload):
+    calls.append(payload)
+
+
+@jobs.handler('test-broken')
+def broken(payload):
+    raise RuntimeError('broken on purpose')
+
+
+def claim_due():
+    #the retries are due at once
+    with db.engine.begin() as conn:
+        conn.execute(Job.__table__.update().values(run_at=datetime.utcnow() - timedelta(seconds=1)))
+    return jobs.claim('test')
+
+
+def test_identical_jobs_are_queued_once(app):
+    with app.app_context():
+        assert jobs.enqueue('test-ok', {'n': 1})
+        assert not jobs.enqueue('test-ok', {'n': 1})
+        assert jobs.enqueue('test-ok', {'n': 2})
+        assert jobs.enqueue('test-ok', {'n': 1}, dedupe=False)
+        db.session.commit()
+        assert db.session.query(Job).count() == 3
+
+
+def test_done_jobs_are_deleted(app):
+    del calls[:]
+    with app.app_context():
+        jobs.enqueue('test-ok', {'n': 1})
+        db.session.commit()
+        row = jobs.claim('test')
+        #claimed once only
+        assert jobs.claim('test') is None
+        assert jobs.run(row) == 'done'
+        assert calls == [{'n': 1}]
+        assert db.session.query(Job).count() == 0
+
+
+def test_rolled_back_jobs_are_not_queued(app):
+    with app.app_context():
+        jobs.enqueue('test-ok', {'n': 1})
+        db.session.rollback()
+        assert jobs.claim('test') is None
+
+
+def test_broken_jobs_retry_then_fail(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'JOBS_MAX_ATTEMPTS', 3)
+    with app.app_context():
+        jobs.enqueue('test-broken', {})
+        db.session.commit()
+        row = jobs.claim('test')
+        assert jobs.run(row) == 'retry'
+        job = db.session.query(Job).one()
+        assert job.state == 'queued' and job.run_at > datetime.utcnow()
+        assert 'broken on purpose' in job.last_error
+        #not due yet
+        assert jobs.claim('test') is None
+        db.session.rollback()
+        assert jobs.run(claim_due()) == 'retry'
+        assert jobs.run(claim_due()) == 'failed'
+        db.session.rollback()
+        job = db.session.query(Job).one()
+        assert (job.state, job.attempts) == ('failed', 3)
+
+
+def picture():
+    data = io.BytesIO()
+    Image.new('RGB', (40, 40), (200, 20, 20)).save(data, 'PNG')
+    return data.getvalue()
+
+
+def test_rolled_back_upload_is_removed(app):
+    user_id = make_user('author')
+    data = picture()
+    path = avatars.spool_path(avatars.storage.content_name(data))
+    with app.app_context():
+        assert avatars.submit(data, user_id)
+        assert os.path.exists(path)
+        #e.g. the new username of the same form was taken
+        db.session.rollback()
+        assert not os.path.exists(path)
+        assert avatars.submit(data, user_id)
+        db.session.commit()
+        assert os.path.exists(path)
+    os.remove(path)
+
+
+def test_worker_survives_database_errors(app, monkeypatch):
+    del calls[:]
+    with app.app_context():
+        jobs.enqueue('test-ok', {'n': 1})
+        jobs.enqueue('test-ok', {'n': 2})
+        db.session.commit()
+    outcomes = []
+
+    def locked(row):
+        outcomes.append(row.id)
+        if len(outcomes) == 1:
+            raise OperationalError('UPDATE job', {}, Exception('database is locked'))
+        return real_run(row)
+    real_run = jobs.run
+    monkeypatch.setattr(jobs, 'run', locked)
+    monkeypatch.setitem(app.config, 'JOBS_POLL_INTERVAL', 0.01)
+    jobs.work('test', threading.Event(), burst=True)
+    #the first job keeps its lease, the worker went on with the second one
+    assert calls == [{'n': 2}]
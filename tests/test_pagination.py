@@ -0,0 +1,101 @@
+'''keyset pagination of the post feeds, see flaskblog/pagination.py'''
+import re
+from flaskblog import db
+from flaskblog.models import Post
+from flaskblog import pagination
+from flaskblog.pagination import paginate_keyset
+from flaskblog.queries import post_feed
+from conftest import make_user, make_posts
+
+
+def test_cursors_walk_every_post_once(app):
+    ids = make_posts(make_user('author'), 12)
+    newest_first = sorted(ids, reverse=True)
+    with app.app_context():
+        page = paginate_keyset(post_feed(), per_page=5)
+        seen = [post.id for post in page.items]
+        while page.has_next:
+            page = paginate_keyset(post_feed(), cursor=page.next_cursor, per_page=5)
+            seen.extend(post.id for post in page.items)
+        #and back again from the last page
+        back = paginate_keyset(post_feed(), cursor=page.prev_cursor, per_page=5)
+    assert seen == newest_first
+    assert page.page == 3
+    assert [post.id for post in back.items] == newest_first[5:10]
+    assert back.page == 2 and back.has_prev and back.has_next
+
+
+def test_cursor_ignores_posts_added_meanwhile(app):
+    author = make_user('author')
+    make_posts(author, 10)
+    with app.app_context():
+        first = paginate_keyset(post_feed(), per_page=5)
+    #a new post would shift an OFFSET page by one
+    make_posts(author, 1, start=first.items[0].date_posted.replace(year=2030))
+    with app.app_context():
+        second = paginate_keyset(post_feed(), cursor=first.next_cursor, per_page=5)
+    assert [post.title for post in second.items] == ['Post %d' % number for number in range(4, -1, -1)]
+
+
+def test_broken_cursor_is_a_bad_request(client):
+    assert client.get('/home?cursor=not-a-cursor').status_code == 400
+
+
+def test_page_past_the_estimate_shows_the_last_page(app, client):
+    ids = make_posts(make_user('author'), 20)
+    #the oldest ten go, max(id) still says 20 posts
+    with app.app_context():
+        for post in Post.query.filter(Post.id.in_(ids[:10])):
+            db.session.delete(post)
+        db.session.commit()
+    #e.g. a bookmarked link
+    response = client.get('/home?page=4')
+    assert response.status_code == 200
+    assert b'Post 10' in response.data and b'Post 14' in response.data
+    assert b'Post 15' not in response.data
+    #its navigation is counted exactly
+    assert b'/home?page=3' not in response.data and b'/home?page=4' not in response.data
+
+
+def nav_links(html):
+    return dict((int(number), url.replace('&amp;', '&')) for url, number in
+                re.findall(r'href="(/home\?[^"]+)">(\d+)</a>', html))
+
+
+def titles(html):
+    return [int(number) for number in re.findall(r'>Post (\d+)</a>', html)]
+
+
+def test_every_page_link_but_the_first_is_a_cursor(app, client):
+    #8 pages, the newest post is Post 39
+    make_posts(make_user('author'), 40)
+    seen, todo = {}, [(1, '/')]
+    while todo:
+        number, url = todo.pop()
+        if number in seen:
+            continue
+        html = client.get(url).data.decode('utf-8')
+        seen[number] = titles(html)
+        for linked, link in nav_links(html).items():
+            assert 'cursor=' in link or link == '/home?page=1', link
+            todo.append((linked, link))
+    assert sorted(seen) == list(range(1, 9))
+    for number, shown in seen.items():
+        assert shown == list(range(44 - 5 * number, 39 - 5 * number, -1)), number
+
+
+def test_links_read_by_keyset(app, monkeypatch):
+    make_posts(make_user('author'), 40)
+    with app.app_context():
+        page = paginate_keyset(post_feed(), per_page=5, count=lambda: 40)
+        #the window and the last page
+        assert sorted(page.cursors) == [2, 3]
+        last = page.link_args(page.pages)['cursor']
+        #no OFFSET scan from here on
+        monkeypatch.setattr(pagination, '_offset_page', None)
+        page = paginate_keyset(post_feed(), cursor=last, per_page=5)
+        back = paginate_keyset(post_feed(), cursor=page.link_args(6)['cursor'], per_page=5)
+    assert (page.page, [post.title for post in page.items]) == (8, ['Post %d' % n for n in range(4, -1, -1)])
+    assert not page.has_next and sorted(page.cursors) == [6, 7, 8]
+    assert (back.page, back.items[0].title) == (6, 'Post 14')
+    assert sorted(back.cursors) == [4, 5, 6, 7, 8]
@@ -0,0 +1,75 @@
+'''the stored profile pictures and flask blog gc-pictures, see flaskblog/storage.py'''
+import io
+import os
+import time
+from PIL import Image
+from flaskblog import db, avatars, storage
+from flaskblog.models import User
+from conftest import make_user, login
+
+
+def picture(color):
+    data = io.BytesIO()
+    Image.new('RGB', (40, 40), color).save(data, 'PNG')
+    return data.getvalue()
+
+
+def store(app, data):
+    #the renditions of an upload, as if they were written a day ago
+    name = storage.content_name(data)
+    with app.app_context():
+        avatars.render_renditions(data, name)
+        age(app, name)
+    return name
+
+
+def age(app, name):
+    day_ago = time.time() - 86400
+    for size in app.config['AVATAR_SIZES']:
+        for ext, _, _ in avatars.FORMATS:
+            os.utime(storage.path_of(avatars.rendition_name(name, size, ext)), (day_ago, day_ago))
+
+
+def gc(app, min_age):
+    result = app.test_cli_runner().invoke(args=['blog', 'gc-pictures', '--min-age', str(min_age)])
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_gc_keeps_the_pictures_of_users(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, 'picture_root', lambda: str(tmp_path))
+    used, orphan = store(app, picture('red')), store(app, picture('blue'))
+    user_id = make_user('author')
+    with app.app_context():
+        db.session.get(User, user_id).image_file = used + '.jpg'
+        db.session.commit()
+    assert 'deleted 8 orphaned files' in gc(app, 3600)
+    assert storage.exists(used + '.jpg') and storage.exists(used + '_32.webp')
+    assert not storage.exists(orphan + '.jpg')
+
+
+def test_gc_keeps_the_renditions_a_queued_job_reuses(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, 'picture_root', lambda: str(tmp_path))
+    data = picture('red')
+    name = store(app, data)
+    user_id = make_user('author')
+    with app.app_context():
+        assert avatars.submit(data, user_id)
+        db.session.commit()
+    #submit made them young again
+    assert os.stat(storage.path_of(name + '.jpg')).st_mtime > time.time() - 60
+    assert 'deleted 0 orphaned files' in gc(app, 3600)
+    #and they are kept for the job whatever their age
+    age(app, name)
+    assert 'deleted 0 orphaned files' in gc(app, 0)
+    assert storage.exists(name + '.jpg')
+
+
+def test_too_large_upload_is_a_form_error(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 1024)
+    login(client, make_user('author'))
+    response = client.post('/account', data={'username': 'author', 'email': 'author@example.com',
+                                             'picture': (io.BytesIO(b'x' * 4096), 'big.png')})
+    assert response.status_code == 413
+    assert avatars.too_large_message() in response.data.decode('utf-8')
+    assert 'value="author@example.com"' in response.data.decode('utf-8')
@@ -0,0 +1,45 @@
+'''the list pages load their posts and authors with a fixed number of SQL statements, see flaskblog/queries.py'''
+import pytest
+from flaskblog import cache
+from flaskblog.testing import QueryCounter, assert_route_queries
+from conftest import make_user, make_posts, login
+
+
+def count_statements(client, url):
+    #the page cache would answer without SQL the second time
+    cache.clear()
+    with QueryCounter() as counter:
+        response = client.get(url)
+    assert response.status_code == 200
+    return counter.count
+
+
+@pytest.mark.parametrize('url', ['/', '/user/author0'])
+def test_list_pages_do_not_query_per_post(app, client, url):
+    authors = [make_user('author%d' % number) for number in range(5)]
+    make_posts(authors[0], 1)
+    one_post = count_statements(client, url)
+    #a full page of 5 posts by 5 different authors on the home page, by one author on user_posts
+    for author in authors:
+        make_posts(author, 1)
+    make_posts(authors[0], 4)
+    assert count_statements(client, url) == one_post
+
+
+def test_logged_in_home_page(app, client):
+    user_id = make_user('reader')
+    for number in range(5):
+        make_posts(make_user('writer%d' % number), 2)
+    login(client, user_id)
+    #load_user is served from the identity cache after the first request
+    client.get('/')
+    cache.clear()
+    response = assert_route_queries(client, '/', 3)
+    assert b'Post 1' in response.data
+
+
+def test_home_page_is_served_from_the_cache(app, client):
+    make_posts(make_user('author'), 3)
+    client.get('/')
+    #only the ETag query is left
+    assert_route_queries(client, '/', 1)
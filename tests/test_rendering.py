@@ -0,0 +1,44 @@
+'''markdown posts and the excerpts cut from them, see flaskblog/rendering.py and flaskblog/excerpts.py'''
+from sqlalchemy import update
+from flaskblog import db
+from flaskblog.excerpts import make_excerpt
+from flaskblog.models import Post
+from flaskblog.rendering import RENDERER_VERSION, render_html, rerender_posts
+from conftest import make_user, make_posts
+
+
+def test_markdown_is_sanitized():
+    html = render_html('Some **bold** [link](https://example.com) <script>alert(1)</script> '
+                       '[bad](javascript:alert(1)) <b onclick="x()">b</b>')
+    assert '<strong>bold</strong>' in html
+    assert '<a href="https://example.com" rel="noopener noreferrer">link</a>' in html
+    assert 'script' not in html and 'javascript' not in html and 'onclick' not in html
+
+
+def test_excerpt_is_the_text_of_the_html():
+    html = render_html('# A title\n\nSome **bold** [link](https://example.com) & more.')
+    assert make_excerpt(html) == 'A title Some bold link & more.'
+    assert make_excerpt(render_html('word ' * 100), length=20) == 'word word word word...'
+
+
+def test_posts_store_html_and_excerpt(app):
+    post_id = make_posts(make_user('author'), 1, content='Some *words* of `code`.')[0]
+    with app.app_context():
+        post = db.session.get(Post, post_id)
+        assert post.content_html == '<p>Some <em>words</em> of <code>code</code>.</p>'
+        assert post.excerpt == 'Some words of code.'
+        post.content = 'New **words**.'
+        assert post.excerpt == 'New words.'
+
+
+def test_rerender_writes_html_and_excerpt(app):
+    post_id = make_posts(make_user('author'), 1, content='Some *words*.')[0]
+    with app.app_context():
+        #a post stored by an older renderer
+        db.session.execute(update(Post).where(Post.id == post_id).values(
+            content_html=None, excerpt=None, renderer_version=None))
+        db.session.commit()
+        assert list(rerender_posts()) == [1]
+        post = db.session.get(Post, post_id)
+        assert (post.content_html, post.excerpt, post.renderer_version) == (
+            '<p>Some <em>words</em>.</p>', 'Some words.', RENDERER_VERSION)
@@ -0,0 +1,80 @@
+'''full-text search, see flaskblog/search.py'''
+import re
+from flask import g
+from flaskblog import db, routes
+from flaskblog.models import Post
+from flaskblog.search import search_posts
+from conftest import make_user, make_posts
+
+
+def found(app, query, per_page=10):
+    with app.app_context():
+        return [post.title for post, snippet in search_posts(query, per_page=per_page).items]
+
+
+def add_post(app, author, title, content):
+    with app.app_context():
+        post = Post(title=title, content=content, user_id=author)
+        db.session.add(post)
+        db.session.commit()
+        return post.id
+
+
+def test_triggers_follow_insert_update_and_delete(app):
+    author = make_user('author')
+    post_id = add_post(app, author, 'Gardening', 'Tomatoes need sun.')
+    assert found(app, 'tomatoes') == ['Gardening']
+    with app.app_context():
+        post = db.session.get(Post, post_id)
+        post.title, post.content = 'Cooking', 'Soup needs salt.'
+        db.session.commit()
+    assert found(app, 'tomatoes') == []
+    assert found(app, 'soup') == ['Cooking']
+    with app.app_context():
+        db.session.delete(db.session.get(Post, post_id))
+        db.session.commit()
+    assert found(app, 'soup') == []
+
+
+def test_title_match_ranks_above_content_match(app):
+    author = make_user('author')
+    add_post(app, author, 'A walk', 'We saw a heron by the river.')
+    add_post(app, author, 'Heron', 'A tall grey bird.')
+    assert found(app, 'heron') == ['Heron', 'A walk']
+
+
+def test_last_word_is_a_prefix_and_operators_are_text(app):
+    author = make_user('author')
+    add_post(app, author, 'Bicycles', 'Fixing a puncture.')
+    assert found(app, 'punct') == ['Bicycles']
+    assert found(app, 'puncture OR "') == []
+
+
+def test_cursor_pages_through_every_match_once(app, client):
+    make_posts(make_user('author'), 25, content='The same words.')
+    numbers, url, pages = [], '/search?q=words', 0
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        html = response.data.decode('utf-8')
+        numbers.extend(int(number) for number in re.findall(r'>Post (\d+)</a>', html))
+        more = re.search(r'href="(/search\?[^"]+)">More results', html)
+        url = more.group(1).replace('&amp;', '&') if more else None
+        pages += 1
+    assert pages == 3
+    assert sorted(numbers) == list(range(25))
+
+
+def test_search_goes_to_the_read_engine(app, client, monkeypatch):
+    seen = []
+
+    def search_posts_and_keep(*args, **kwargs):
+        seen.append(g.get('read_only'))
+        return search_posts(*args, **kwargs)
+    monkeypatch.setattr(routes, 'search_posts', search_posts_and_keep)
+    assert client.get('/search?q=words').status_code == 200
+    assert seen == [True]
+
+
+def test_bad_cursor(app, client):
+    assert client.get('/search?q=words&cursor=not-a-cursor').status_code == 400
@@ -0,0 +1,61 @@
+'''the author statistics follow the posts in the same flush, see flaskblog/stats.py'''
+from datetime import datetime
+from sqlalchemy.orm import defer
+from flaskblog import db
+from flaskblog.models import User, Post
+from conftest import make_user, make_posts
+
+
+def stats(app, user_id):
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        return user.post_count, user.last_post_at, user.content_bytes
+
+
+def test_insert_counts_the_post(app):
+    author = make_user('author')
+    make_posts(author, 2, content='héllo')
+    #the size is counted in utf-8 bytes, é takes two
+    assert stats(app, author) == (2, datetime(2020, 1, 1, 0, 1), 12)
+
+
+def test_delete_takes_the_post_off(app):
+    author = make_user('author')
+    first, newest = make_posts(author, 2, content='abc')
+    with app.app_context():
+        db.session.delete(db.session.get(Post, newest))
+        db.session.commit()
+    assert stats(app, author) == (1, datetime(2020, 1, 1), 3)
+
+
+def test_reassigned_post_moves_to_the_new_author(app):
+    author, other = make_user('author'), make_user('other')
+    post_id = make_posts(author, 1, content='abcd')[0]
+    with app.app_context():
+        db.session.get(Post, post_id).user_id = other
+        db.session.commit()
+    assert stats(app, author) == (0, None, 0)
+    assert stats(app, other) == (1, datetime(2020, 1, 1), 4)
+
+
+def test_content_change_updates_the_size(app):
+    author = make_user('author')
+    post_id = make_posts(author, 1, content='abcd')[0]
+    with app.app_context():
+        db.session.get(Post, post_id).content = 'ab'
+        db.session.commit()
+    assert stats(app, author) == (1, datetime(2020, 1, 1), 2)
+
+
+def test_unloaded_content_is_counted_again(app):
+    author, other = make_user('author'), make_user('other')
+    first, second, third = make_posts(author, 3, content='abc')
+    with app.app_context():
+        #the content is never read, so its size is unknown to the listeners
+        deferred = db.select(Post).options(defer(Post.content))
+        db.session.delete(db.session.scalars(deferred.filter_by(id=third)).one())
+        db.session.commit()
+        db.session.scalars(deferred.filter_by(id=second)).one().user_id = other
+        db.session.commit()
+    assert stats(app, author) == (1, datetime(2020, 1, 1), 3)
+    assert stats(app, other) == (1, datetime(2020, 1, 1, 0, 1), 3)